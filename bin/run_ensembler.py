@@ -14,7 +14,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import logging
 from datetime import datetime
-from src.data.imgproc import tf_read_image
+from src.data.tfpipeline import inference_pipeline, model_channels
 from src.data.dataset import ImageDataset
 from src.models.sklearn_models import models
 from src.models.tensorflow_models import cnn_models
@@ -83,31 +83,14 @@ if __name__ == '__main__':
                            ['normalize',{}]]
     
     #set up test dataset
-    tfds_test = tf.data.Dataset.from_tensor_slices((test_dataset.df[test_dataset._feature_header].values,
-                                                    test_dataset.df['Path'].values,
-                                                    test_dataset.df[return_labels].values))
-    tfds_test_keras = tfds_test.map(lambda x, y, z: tf_read_image(x, y, z, 
-                                                                  cnn_model="MobileNetv2_keras",
-                                                                  transformations=cnn_transformations),
-                                    num_parallel_calls=tf.data.AUTOTUNE)
-    tfds_test = tfds_test.map(lambda x, y, z: tf_read_image(x, y, z, 
-                                                            cnn_model="DenseNet121_new",
-                                                            transformations=cnn_transformations),
-                              num_parallel_calls=tf.data.AUTOTUNE)
+    #images are decoded one by one, then transformed a batch at a time, and prefetched
+    #model inputs by number of image channels, the saved keras application models take rgb images
+    tfds_test_inputs = {}
     
-    tfds_test_keras = tfds_test_keras.batch(batch_size)
-    tfds_test = tfds_test.batch(batch_size)
-    
-    #prefetch
-    tfds_test = tfds_test.prefetch(tf.data.AUTOTUNE)
-    
-    #extract labels
-    y_test_multi = []
-    for x, test_label in tfds_test:
-        for item in test_label:
-            y_test_multi.append(item.numpy())
-    
-    y_test_multi = np.array(y_test_multi)
+    #extract labels, in the order the models predict the test images in, without decoding the images
+    y_test_multi = pd.DataFrame(test_dataset.labels(return_labels), columns=return_labels)
+    #test inputs of the traditional models, loaded once for all of them
+    X_test = None
     
     #create dictionary to store the results
     y_pred_multi = {}
@@ -177,9 +160,10 @@ if __name__ == '__main__':
             except:
                 logger.error(f'Pretrained model {model_f_path} file cannot be loaded!')
             
-            x_features_test, x_image_test, y_test_multi = test_dataset.load(return_labels)
-            x_image_test = MinMaxScaler().fit_transform(pca.transform(x_image_test))
-            X_test = pd.concat([pd.DataFrame(x_features_test), pd.DataFrame(x_image_test)], axis=1)
+            if X_test is None:
+                x_features_test, x_image_test, _ = test_dataset.load(return_labels)
+                x_image_test = MinMaxScaler().fit_transform(pca.transform(x_image_test))
+                X_test = pd.concat([pd.DataFrame(x_features_test), pd.DataFrame(x_image_test)], axis=1)
             
             #reshape the output
             y_pred_helper = np.array(model_used.predict_proba(X_test))
@@ -211,17 +195,15 @@ if __name__ == '__main__':
                 logger.error(f'Unable to load pretrained cnn model: {cnn_pretrained_path} !')
             
             #create new dictionary entry for the results
-            #use 3 channel if keras model
-            if str.split(model_name,'_')[1] == 'keras':
-                y_pred_multi[model_name] = model_used.predict(tfds_test_keras, 
-                                                              verbose=1, 
-                                                              use_multiprocessing=True, 
-                                                              workers=8)
-            else: 
-                y_pred_multi[model_name] = model_used.predict(tfds_test, 
-                                                              verbose=1, 
-                                                              use_multiprocessing=True, 
-                                                              workers=8)
+            #use the channels the model takes
+            channels = model_channels(model_used)
+            if channels not in tfds_test_inputs:
+                tfds_test_inputs[channels] = inference_pipeline(test_dataset, batch_size, cnn_transformations,
+                                                                channels=channels)
+            y_pred_multi[model_name] = model_used.predict(tfds_test_inputs[channels], 
+                                                          verbose=1, 
+                                                          use_multiprocessing=True, 
+                                                          workers=8)
             
             #add model to list, only if used
             model_list.append(model_name)
@@ -13,13 +13,15 @@ import tensorflow as tf
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from src.data.imgproc import tf_read_image
+from src.data.imgproc import deterministic_length
+from src.data.tfpipeline import train_pipeline, eval_pipeline, embed_images, embedding_pipeline, model_channels
 from src.data.dataset import ImageDataset
+from src.data.batchloader import concat_features
 from sklearn.decomposition import IncrementalPCA
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.multioutput import MultiOutputClassifier
 from src.models.sklearn_models import models
-from src.models.tensorflow_models import cnn_models
+from src.models.tensorflow_models import cnn_models, backbone, split_head
 from sklearn.metrics import roc_auc_score, roc_curve, f1_score, accuracy_score
 from tensorflow.keras import mixed_precision
 from keras import backend as K
@@ -97,6 +99,33 @@ if __name__ == '__main__':
     parser.add_argument("--steps_execute", type=int, default=50, help="Number of steps per execution.")
     parser.add_argument("--layer_train", type=int, default=10,
                         help="Number of layer groups to train for each step during 1st epoch.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory for the persistent cache of transformed images. No caching if not given.")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of worker processes for loading image batches, 0 to load in the main process.")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Number of image batches to load ahead while training, 0 to disable prefetching.")
+    parser.add_argument("--shard_dir", type=str, default=None,
+                        help="Directory of the image shards packed by make_dataset, e.g. data/processed. "
+                             "Images are read from the jpeg files if not given.")
+    parser.add_argument("--shuffle", type=int, default=0, choices=[0, 1],
+                        help="1 to feed the training batches of partial_fit in a seeded random order, 0 in file order")
+    parser.add_argument("--tf_cache_dir", type=str, default=None,
+                        help="Directory for the tf.data cache of decoded and deterministically transformed CNN "
+                             "inputs. No caching if not given.")
+    parser.add_argument("--tf_shuffle_buffer", type=int, default=None,
+                        help="Cached CNN training images held in the shuffle buffer, with --tf_cache_dir. "
+                             "16 batches if not given.")
+    parser.add_argument("--image_dtype", type=str, default="float32", choices=["float32", "uint8"],
+                        help="Images of the CNN input pipeline. uint8 keeps them unnormalized, the model scales them.")
+    parser.add_argument("--proc_module", type=str, default="skimage", choices=["skimage", "cv2"],
+                        help="Image processing backend of the sklearn models.")
+    parser.add_argument("--tf_deterministic", type=int, default=1, choices=[0, 1],
+                        help="0 to let the parallel reads of the CNN training images finish out of order")
+    parser.add_argument("--embedding_dir", type=str, default=None,
+                        help="Directory of the cached image embeddings of frozen CNN bases. With --cnn_transfer 1, "
+                             "the keras application bases embed the images once and only the head is trained. "
+                             "The whole CNN is trained on the images if not given.")
 
     args = parser.parse_args()
     logger.info(f'==============================================')
@@ -154,14 +183,17 @@ if __name__ == '__main__':
 
     train_dataset = ImageDataset(label_csv_path=train_csv_path, image_path_base=image_path, limit=limit,
                                  transformations=preprocessing_config["transformations"], map_option=args.map,
-                                 frontal_only=frontal_only)
+                                 frontal_only=frontal_only, cache_dir=args.cache_dir, proc_module=args.proc_module,
+                                 shard_dir=args.shard_dir and os.path.join(args.shard_dir, "train"))
     class_weight_list = train_dataset.get_class_weights(return_labels)
     classes = np.array([[0, 1] for y in return_labels]).astype(np.float32)
 
     if args.validsize is not None:
         valid_dataset = train_dataset.split(validsize=args.validsize, transformations=test_transformations)
     test_dataset = ImageDataset(label_csv_path=test_csv_path, image_path_base=image_path,
-                                frontal_only=frontal_only, transformations=test_transformations)
+                                frontal_only=frontal_only, transformations=test_transformations,
+                                cache_dir=args.cache_dir, proc_module=args.proc_module,
+                                shard_dir=args.shard_dir and os.path.join(args.shard_dir, "valid"))
 
     logger.info(f'train_dataset: {train_dataset}, {train_csv_path}')
     logger.info(f'test_dataset: {test_dataset}, {test_csv_path}')
@@ -182,48 +214,22 @@ if __name__ == '__main__':
         logger.info(f'Setting dataset for CNN')
         logger.info(f'model: {args.cnn_model}')
 
-        df_train = train_dataset.df
-        df_valid = valid_dataset.df
-
-        tfds_train = tf.data.Dataset.from_tensor_slices((df_train[train_dataset._feature_header].values,
-                                                         df_train['Path'].values, df_train[return_labels].values))
-        tfds_valid = tf.data.Dataset.from_tensor_slices((df_valid[train_dataset._feature_header].values,
-                                                         df_valid['Path'].values, df_valid[return_labels].values))
-        tfds_test = tf.data.Dataset.from_tensor_slices((test_dataset.df[test_dataset._feature_header].values,
-                                                        test_dataset.df['Path'].values,
-                                                        test_dataset.df[return_labels].values))
-
-        tfds_train = tfds_train.map(lambda x, y, z: tf_read_image(x, y, z, cnn_model=args.cnn_model,
-                                                                  transformations=test_transformations),
-                                    num_parallel_calls=tf.data.AUTOTUNE)
-        tfds_valid = tfds_valid.map(lambda x, y, z: tf_read_image(x, y, z, cnn_model=args.cnn_model,
-                                                                  transformations=test_transformations),
-                                    num_parallel_calls=tf.data.AUTOTUNE)
-        tfds_test = tfds_test.map(lambda x, y, z: tf_read_image(x, y, z, cnn_model=args.cnn_model,
-                                                                transformations=test_transformations),
-                                  num_parallel_calls=tf.data.AUTOTUNE)
-
-        #required for batching
-        tfds_train = tfds_train.batch(batch_size)
-        tfds_valid = tfds_valid.batch(batch_size)
-        tfds_test = tfds_test.batch(batch_size)
-
-        #prefetch
-        tfds_train = tfds_train.prefetch(tf.data.AUTOTUNE)
-        tfds_valid = tfds_valid.prefetch(tf.data.AUTOTUNE)
-        tfds_test = tfds_test.prefetch(tf.data.AUTOTUNE)
+        #images are decoded one by one, then transformed a batch at a time, and prefetched
+        #one training pipeline for all the unfreezing steps and epochs, fit takes steps_per_epoch batches from it
+        tfds_train = train_pipeline(train_dataset, batch_size, test_transformations, return_labels,
+                                    image_dtype=args.image_dtype, cache_dir=args.tf_cache_dir,
+                                    shuffle_buffer=args.tf_shuffle_buffer,
+                                    deterministic=bool(args.tf_deterministic))
+        tfds_valid = eval_pipeline(valid_dataset, batch_size, test_transformations, return_labels,
+                                   image_dtype=args.image_dtype, cache_dir=args.tf_cache_dir)
 
 
         for feat, lab in tfds_train.take(1):
             feature_shape = (feat[0].shape[1],)
             image_shape = (feat[1].shape[1], feat[1].shape[2], feat[1].shape[3])
 
-        y_test_multi = []
-        for x, test_label in tfds_test:
-            for item in test_label:
-                y_test_multi.append(item.numpy())
-
-        y_test_multi = np.array(y_test_multi)
+        #labels in the order of tfds_test, without decoding the images
+        y_test_multi = test_dataset.labels(return_labels)
 
         output_size = len(return_labels)
         not_transfer = not bool(args.cnn_transfer)
@@ -233,9 +239,33 @@ if __name__ == '__main__':
             model = cnn_models[args.cnn_model](output_size=output_size,
                                               not_transfer=not_transfer,
                                               feature_shape=feature_shape,
-                                              image_shape=image_shape)
+                                              image_shape=image_shape,
+                                              image_dtype=args.image_dtype)
             logger.info(model.summary())
             logger.info(f'Executing callback every {steps_execute} batches')
+            tfds_test = eval_pipeline(test_dataset, batch_size, test_transformations, return_labels,
+                                      image_dtype=args.image_dtype, cache_dir=args.tf_cache_dir)
+
+            #with a frozen cnn base, the images are embedded once and only the head is trained on the embeddings,
+            #the head layers are shared with the model, which is saved as usual
+            train_model = model
+            split = None
+            if args.embedding_dir is not None and not not_transfer:
+                split = split_head(model)
+                if split is None:
+                    logger.warning(f'{args.cnn_model} has no frozen cnn base with a head, training on the images')
+                elif deterministic_length(test_transformations) < len(test_transformations):
+                    logger.warning('Random transformations cannot be embedded once, training on the images')
+                    split = None
+            if split is not None:
+                embedding_model, train_model = split
+                logger.info(f'Embedding the images with {embedding_model.name} into {args.embedding_dir}')
+                embeddings = [embed_images(embedding_model, dataset, batch_size, test_transformations,
+                                           args.embedding_dir, args.image_dtype)
+                              for dataset in [train_dataset, valid_dataset, test_dataset]]
+                tfds_train = embedding_pipeline(train_dataset, embeddings[0], batch_size, return_labels, train=True)
+                tfds_valid = embedding_pipeline(valid_dataset, embeddings[1], batch_size, return_labels)
+                tfds_test = embedding_pipeline(test_dataset, embeddings[2], batch_size, return_labels)
 
             model_checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(
                 filepath=cnn_fname,
@@ -261,9 +291,10 @@ if __name__ == '__main__':
 
             history_list = []
 
-            model.layers[2].trainable = True
+            cnn_base = backbone(model)
+            cnn_base.trainable = True
             #maximum number of layers in CNN model
-            cnn_layers_N = len(model.layers[2].layers)
+            cnn_layers_N = len(cnn_base.layers)
 
             if args.layer_train == -1:
                 layer_train = cnn_layers_N
@@ -273,9 +304,13 @@ if __name__ == '__main__':
             steps_per_epoch = num_batch // layer_train
             layer_steps = cnn_layers_N // layer_train
 
-            for layer in model.layers[2].layers:
+            for layer in cnn_base.layers:
                 layer.trainable = False
 
+            #one iterator over the repeated training batches for all the fits, so each layer group and epoch
+            #takes the next steps of the same stream, with its prefetched batches and partly written cache
+            train_iter = iter(tfds_train)
+
             # unfreeze each layer group one at a time for the 1st epoch
             if not_transfer:
                 for l in range(layer_train):
@@ -285,7 +320,7 @@ if __name__ == '__main__':
                     else:
                         max_idx = (l + 1) * layer_steps
 
-                    for layer in model.layers[2].layers[::-1][min_idx: max_idx]:
+                    for layer in cnn_base.layers[::-1][min_idx: max_idx]:
                         #unfreeze group of layers according the user argument
                         layer.trainable = True
 
@@ -298,21 +333,11 @@ if __name__ == '__main__':
 
                     if l == layer_train - 1:
                         #perform validation test at the end of 1st epoch
-                        history = model.fit(tfds_train, batch_size=batch_size, epochs=1, validation_data=tfds_valid,
-                                            verbose=1, use_multiprocessing=True, workers=8, steps_per_epoch=steps_per_epoch)
+                        history = model.fit(train_iter, batch_size=batch_size, epochs=1, validation_data=tfds_valid,
+                                            verbose=1, steps_per_epoch=steps_per_epoch)
                     else:
-                        history = model.fit(tfds_train, batch_size=batch_size, epochs=1,
-                                            verbose=1, use_multiprocessing=True, workers=8, steps_per_epoch=steps_per_epoch)
-                        #reshuffle dataset
-                        df_train = df_train.sample(frac=1.0).reset_index(drop=True)
-                        tfds_train = tf.data.Dataset.from_tensor_slices((df_train[train_dataset._feature_header].values,
-                                                                         df_train['Path'].values,
-                                                                         df_train[return_labels].values))
-                        tfds_train = tfds_train.map(lambda x, y, z: tf_read_image(x, y, z, cnn_model=args.cnn_model,
-                                                                                  transformations=test_transformations),
-                                                    num_parallel_calls=tf.data.AUTOTUNE)
-                        tfds_train = tfds_train.batch(batch_size)
-                        tfds_train = tfds_train.prefetch(tf.data.AUTOTUNE)
+                        history = model.fit(train_iter, batch_size=batch_size, epochs=1,
+                                            verbose=1, steps_per_epoch=steps_per_epoch)
 
                     history_list.append(history.history)
 
@@ -324,14 +349,14 @@ if __name__ == '__main__':
             #https://datascience.stackexchange.com/questions/41698/how-to-apply-class-weight-to-a-multi-output-model
 
             #train again with all the weights unfreezed for the remaining epochs
-            model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=cnn_param_config['learning_rate']),
+            train_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=cnn_param_config['learning_rate']),
                           steps_per_execution=steps_execute,
                           loss=get_weighted_loss(class_weight_list, cnn_param_config['loss']),
                           metrics=[tf.keras.metrics.AUC(multi_label=True), 'binary_accuracy', tf.keras.metrics.Precision(),
                                    tf.keras.metrics.Recall()])
 
-            history = model.fit(tfds_train, batch_size=batch_size, epochs=epochs, validation_data=tfds_valid,
-                                verbose=1, use_multiprocessing=True, workers=8)
+            history = train_model.fit(train_iter, batch_size=batch_size, epochs=epochs, validation_data=tfds_valid,
+                                      verbose=1, steps_per_epoch=num_batch)
             history_list.append(history.history)
 
             model.save(cnn_fname)
@@ -344,22 +369,34 @@ if __name__ == '__main__':
                 cnn_pretrained_path = os.path.join(base_path, "models", args.cnn_pretrained)
                 logger.info(f'Loading pretrained cnn model: {cnn_pretrained_path}')
                 model = tf.keras.models.load_model(cnn_pretrained_path, compile=False)
+                train_model = model
+                #the test images get the channels of the loaded model, e.g. 3 for the imagenet stems
+                tfds_test = eval_pipeline(test_dataset, batch_size, test_transformations, return_labels,
+                                          channels=model_channels(model), image_dtype=args.image_dtype,
+                                          cache_dir=args.tf_cache_dir)
                 logger.info(model.summary())
             except:
                 logger.error(f'Unable to load pretrained cnn model: {args.cnn_pretrained} !')
 
-        y_pred_multi = model.predict(tfds_test, verbose=1, use_multiprocessing=True, workers=8)
+        y_pred_multi = train_model.predict(tfds_test, verbose=1, use_multiprocessing=True, workers=8)
         #x_features_test, x_image_test, y_test_multi = test_dataset.load(return_labels)
 
     # Pipeline for sklearn
     else:
+        #every pass over the training images is an epoch of its own, with its own order and random transformations
+        train_epoch = 0
         if process_pca:
             logger.info(f'Setting up pca')
             if args.pca_pretrained is None:
                 pca = IncrementalPCA(n_components=args.pca_n_components, whiten=True, batch_size=batch_size)
-                for i, (x_features, x_image, y) in enumerate(train_dataset.batchloader(batch_size, return_labels)):
+                for i, (x_features, x_image, y) in enumerate(train_dataset.batchloader(batch_size, return_labels,
+                                                                                       num_workers=args.num_workers,
+                                                                                       prefetch=args.prefetch,
+                                                                                       return_numpy=True,
+                                                                                       epoch=train_epoch)):
                     logger.info(f'Training pca on batch {(i + 1)} out of {num_batch}')
                     pca.partial_fit(x_image)
+                train_epoch += 1
                 end_time = datetime.now()
                 logger.info('PCA fit duration: {}'.format(end_time - start_time))
                 logger.info(f'Saving pca model .sav file... ')
@@ -386,10 +423,15 @@ if __name__ == '__main__':
             model = base_model
 
         if args.model_pretrained is None:
-            for i, (x_features, x_image, y) in enumerate(train_dataset.batchloader(batch_size, return_labels)):
+            for i, (x_features, x_image, y) in enumerate(train_dataset.batchloader(batch_size, return_labels,
+                                                                                   num_workers=args.num_workers,
+                                                                                   prefetch=args.prefetch,
+                                                                                   return_numpy=True,
+                                                                                   shuffle=bool(args.shuffle),
+                                                                                   epoch=train_epoch)):
                 if process_pca:
                     x_image = MinMaxScaler().fit_transform(pca.transform(x_image))
-                X = pd.concat([pd.DataFrame(x_features), pd.DataFrame(x_image)], axis=1)
+                X = concat_features(x_features, x_image)
                 if num_batch == 1:
                     logger.info(f'Training model full batch without partial fit')
                     model.fit(X, y)
@@ -411,10 +453,11 @@ if __name__ == '__main__':
                 logger.error(f'Pretrained model {model_f_path} .sav file cannot be loaded!')
 
         logger.info(f'Running model on test dataset...')
-        x_features_test, x_image_test, y_test_multi = test_dataset.load(return_labels)
+        x_features_test, x_image_test, y_test_multi = test_dataset.load(return_labels, num_workers=args.num_workers,
+                                                                        return_numpy=True)
         if process_pca:
             x_image_test = MinMaxScaler().fit_transform(pca.transform(x_image_test))
-        X_test = pd.concat([pd.DataFrame(x_features_test), pd.DataFrame(x_image_test)], axis=1)
+        X_test = concat_features(x_features_test, x_image_test)
 
         y_pred_multi = np.array(model.predict_proba(X_test))
         y_pred_labels = np.array(model.predict(X_test))
@@ -433,11 +476,10 @@ if __name__ == '__main__':
         os.makedirs(results_path)
 
     for idx, label in enumerate(return_labels):
+        y_test = y_test_multi[:, idx]
         if process_cnn:
-            y_test = y_test_multi[:, idx]
             y_pred = y_pred_multi[:, idx]
         else:
-            y_test = y_test_multi[label]
             y_pred = y_pred_multi[idx, :, 1]
             #y_pred_label = y_pred_labels[:, idx]
         y_pred_label = np.zeros(shape=y_pred.shape)
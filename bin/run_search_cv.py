@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 from sklearn.utils.class_weight import compute_class_weight
 from src.data.imgproc import tf_read_image
 from src.data.dataset import ImageDataset
+from src.data.batchloader import concat_features
 from sklearn.decomposition import IncrementalPCA
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.multioutput import MultiOutputClassifier
@@ -84,6 +85,15 @@ def parse_args():
                         type=bool,
                         default=False,
                         help="Whether to use RandomizedSearchCV.")
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        default=None,
+                        help="Directory for the persistent image cache.")
+    parser.add_argument("--dtype",
+                        type=str,
+                        default='float32',
+                        choices=['float32', 'float16', 'uint8'],
+                        help="Dtype the loaded images are stored with.")
 
     args = parser.parse_args()
     return args
@@ -117,7 +127,8 @@ def load_dataset(args):
         image_path_base=image_path,
         limit=args.limit,
         transformations=preprocessing_config["transformations"],
-        map_option=args.map)
+        map_option=args.map,
+        cache_dir=args.cache_dir)
 
     return train_dataset
 
@@ -169,17 +180,17 @@ def main():
     logger.info(f'RandomizedSearchCV: {args.random}')
 
     x_features_train, x_image_train, y_train_multi = train_dataset.load(
-        return_labels)
+        return_labels, return_numpy=True, dtype=args.dtype)
+    # One label column per entry of return_labels, also for a single label
+    y_train_multi = y_train_multi.reshape(len(y_train_multi), -1)
     if pca:
         x_image_train = MinMaxScaler().fit_transform(
             pca.transform(x_image_train))
 
-    X_train = pd.concat(
-        [pd.DataFrame(x_features_train),
-         pd.DataFrame(x_image_train)], axis=1)
+    X_train = concat_features(x_features_train, x_image_train)
 
-    for label in return_labels:
-        y_train = y_train_multi[label]
+    for idx, label in enumerate(return_labels):
+        y_train = y_train_multi[:, idx]
         logger.info(f'==============================================')
         logger.info(f'Run search_cv for label: {label}')
         scoring = 'roc_auc'
@@ -1,28 +1,263 @@
+import multiprocessing
+import queue
+import threading
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
 
+# Dataset of a worker process, set once by the pool initializer
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+    # Only the parent process writes to the image cache
+    if dataset.cache is not None:
+        dataset.cache.readonly = True
+
+
+def _load_chunk(shm_name, shape, dtype, offset, indices, epoch):
+    """Load the images of a chunk into the shared memory buffer of the batch.
+
+    Args:
+        shm_name (str): Name of the shared memory block holding the batch images.
+        shape (tuple): Shape of the batch image array.
+        dtype (str): Dtype of the batch image array.
+        offset (int): Row of the batch array for the first image of the chunk.
+        indices (list): Dataset indices of the chunk.
+        epoch (int): Epoch seeding the random transformations.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    images = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        _worker_dataset.read_images(_worker_dataset._paths[indices], out=images[offset:offset + len(indices)],
+                                    epoch=epoch)
+    finally:
+        del images
+        shm.close()
+
+
+def _read_chunk(indices, epoch):
+    """Read the images of a chunk, sent back through pickling while the batch image shape is unknown.
+
+    Args:
+        indices (list): Dataset indices of the chunk.
+        epoch (int): Epoch seeding the random transformations.
+
+    Returns:
+        np.array: The transformed images stacked along the first axis.
+    """
+    return _worker_dataset.read_images(_worker_dataset._paths[indices], epoch=epoch)
+
+
 class BatchLoader:
-    def __init__(self, dataset, batch_size, return_labels=None, without_image=False, return_X_y=True):
+    # Images in the shared memory buffer of each worker, bounding the memory of large batches
+    shared_rows_per_worker = 64
+    # Images transformed at once when loading without workers, bounding the temporary arrays of large batches
+    serial_rows = 64
+
+    def __init__(self, dataset, batch_size, return_labels=None, without_image=False, return_X_y=True,
+                 num_workers=0, return_numpy=False, dtype='float32', shuffle=False, seed=None, epoch=0):
         self.dataset = dataset
         self.batch_size = batch_size
         self.return_labels = return_labels
         self.data_size = len(dataset)
         self.start = 0
+        self.shuffle = shuffle
+        # Shards of one dataset must draw the same permutation, hence the dataset seed by default
+        self.seed = dataset.random_state if seed is None else seed
+        # Epoch of the next iteration, a new loader of a later epoch must be given it
+        self.epoch = epoch
+        self._epoch = epoch
+        self._shard = (0, 1)
+        self._order = None
         self.without_image = without_image
         self.return_X_y = return_X_y
+        self.num_workers = num_workers
+        self.return_numpy = return_numpy
+        self.dtype = dtype
+        self._pool = None
+        self._shm = None
+        self._image_spec = None
 
     def __iter__(self):
         self.start = 0
+        self._order = self._epoch_order(self.epoch)
+        # Epoch of the current iteration, seeding the random transformations
+        self._epoch = self.epoch
+        self.epoch += 1
         return self
 
+    def __len__(self):
+        return self.data_size // self.batch_size + bool(self.data_size % self.batch_size)
+
+    def __del__(self):
+        self.close()
+
+    def shard(self, index, count):
+        """Only load every count-th row of the dataset starting at index, so count loaders
+        with the same seed consume disjoint parts of the dataset.
+
+        Args:
+            index (int): Index of the shard to load.
+            count (int): Total number of shards.
+
+        Returns:
+            BatchLoader: self
+        """
+        if not 0 <= index < count:
+            raise ValueError(f'Shard index {index} is not in [0, {count})')
+        self._shard = (index, count)
+        self.data_size = len(range(index, len(self.dataset), count))
+        return self
+
+    def _epoch_order(self, epoch):
+        """Dataset rows in the order they are loaded in an epoch, None to load all rows in order."""
+        index, count = self._shard
+        if self.shuffle:
+            # Seeded per epoch, so every epoch is shuffled differently but can be reproduced
+            order = np.random.default_rng([self.seed, epoch]).permutation(len(self.dataset))
+            return order[index::count]
+        if count > 1:
+            return np.arange(index, len(self.dataset), count)
+        return None
+
+    def _batch_rows(self, start, end):
+        """Dataset rows of a batch. A slice when loading in order, so features and labels are not copied."""
+        if self._order is None:
+            return slice(start, end)
+        return self._order[start:end]
+
+    def close(self):
+        """Shut down the worker pool and release the shared memory buffer."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _load_parallel(self, rows, out):
+        """Load the images of a batch with the worker pool into out, of shape (len(rows), *image shape).
+        Workers write the images into a shared memory buffer of at most shared_rows_per_worker images
+        each, copied into out a part at a time. Nothing is sent back through pickling, and a large
+        batch, e.g. of load, is not held twice in memory.
+        """
+        image_shape, image_dtype = self._image_spec
+        capacity = self._capacity()
+        shape = (capacity, *image_shape)
+        self._start_pool()
+        if self._shm is None:
+            nbytes = int(np.prod(shape)) * image_dtype.itemsize
+            self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+
+        buffer = np.ndarray(shape, dtype=image_dtype, buffer=self._shm.buf)
+        for start in range(0, len(rows), capacity):
+            part = rows[start:start + capacity]
+            chunks = self._chunks(part)
+            offsets = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+            self._pool.starmap(_load_chunk, [(self._shm.name, shape, image_dtype.str, offset, chunk.tolist(),
+                                              self._epoch) for offset, chunk in zip(offsets, chunks)])
+            out[start:start + len(part)] = buffer[:len(part)]
+            self._put_cache(part, buffer)
+        # No view of the shared buffer may outlive the batch, or it cannot be closed
+        del buffer
+        return out
+
+    def _read_first(self, rows):
+        """Read the first image of the first batch with a worker, sent back through pickling, and take
+        the shape and dtype of the batch images from it. The other images go through the shared buffer.
+        """
+        self._start_pool()
+        images = self._pool.apply(_read_chunk, ([int(rows[0])], self._epoch))
+        self._image_spec = (images.shape[1:], images.dtype)
+        self._put_cache(rows[:1], images)
+        return images
+
+    def _put_cache(self, rows, images):
+        """Write the images the workers loaded to the image cache of the dataset. The cache only holds
+        the deterministic prefix, so images that went through random transformations are not cached.
+        """
+        if self.dataset.cache is None or self.dataset._suffix.steps:
+            return
+        for path, image in zip(self.dataset._paths[rows], images):
+            self.dataset.cache.put(path, image)
+
+    def _start_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.get_context().Pool(self.num_workers, initializer=_init_worker,
+                                                           initargs=(self.dataset,))
+
+    def _capacity(self):
+        # Images loaded by the workers at once
+        return min(self.batch_size, self.num_workers * self.shared_rows_per_worker)
+
+    def _chunks(self, rows):
+        return [chunk for chunk in np.array_split(rows, self.num_workers) if len(chunk)]
+
+    def _allocate(self, num_rows, image_shape, image_dtype):
+        """Allocate the output arrays of a batch from the shape and dtype of its images.
+
+        Float outputs share one array of shape (batch, features + image size), other dtypes
+        keep the features in a separate float32 array.
+        """
+        num_features = len(self.dataset._feature_header)
+        dtype = np.dtype(self.dtype)
+        image_size = int(np.prod(image_shape))
+        if dtype.kind == 'f':
+            data = np.empty((num_rows, num_features + image_size), dtype=dtype)
+            return data[:, :num_features], data[:, num_features:]
+        if image_dtype != dtype:
+            raise ValueError(f'{dtype} output cannot hold {image_dtype} images without loss, use a float dtype')
+        return np.empty((num_rows, num_features), dtype=np.float32), np.empty((num_rows, image_size), dtype=dtype)
+
+    def _image_view(self, x_image):
+        """View of the flattened image columns of a batch as images, writing through to them."""
+        out = x_image.view()
+        out.shape = (len(x_image), *self._image_spec[0])
+        return out
+
+    def _load_numpy(self, rows):
+        """Load the dataset rows of a batch into preallocated arrays, filled in place.
+
+        Returns:
+            x_features, x_image, labels: Features, flattened images and label array of the batch.
+        """
+        paths = self.dataset._paths[rows]
+        if self.num_workers > 0 and isinstance(rows, slice):
+            rows = np.arange(rows.start, rows.stop)
+        num_first = 0
+        if self._image_spec is None:
+            # The image shape is only known after transforming the first image
+            if self.num_workers > 0:
+                first = self._read_first(rows)
+            else:
+                first = self.dataset.read_images(paths[:1], epoch=self._epoch)
+                self._image_spec = (first.shape[1:], first.dtype)
+            num_first = len(first)
+        x_features, x_image = self._allocate(len(paths), *self._image_spec)
+        out = self._image_view(x_image)
+        if num_first:
+            out[:num_first] = first
+        if self.num_workers > 0:
+            self._load_parallel(rows[num_first:], out[num_first:])
+        else:
+            # The images are transformed straight into the output array, a few at a time
+            for start in range(num_first, len(paths), self.serial_rows):
+                end = start + self.serial_rows
+                self.dataset.read_images(paths[start:end], out=out[start:end], epoch=self._epoch)
+        x_features[:] = self.dataset._features[rows]
+        return x_features, x_image, self.dataset._labels[rows]
+
     def __next__(self):
         if self.start >= self.data_size:
             raise StopIteration
         start = self.start
         end = min(start + self.batch_size, self.data_size)
-        all_features = []
-        image_features = []
-        all_labels = []
+        rows = self._batch_rows(start, end)
         if self.without_image:
             featrue_columns = ['Path'] + self.dataset._feature_header.tolist()
             if self.return_labels:
@@ -31,28 +266,139 @@ class BatchLoader:
                 labels_columns = self.dataset._label_header.tolist()
                 
             if self.return_X_y:
-                features = self.dataset.df.iloc[start:end][featrue_columns]
-                labels = self.dataset.df.iloc[start:end][labels_columns]
+                features = self.dataset.df.iloc[rows][featrue_columns]
+                labels = self.dataset.df.iloc[rows][labels_columns]
                 self.start = end
                 return features, labels
             else:
                 columns = featrue_columns + labels_columns
-                data = self.dataset.df.iloc[start:end][columns]
+                data = self.dataset.df.iloc[rows][columns]
                 self.start = end
                 return data
         else:
-            for i in range(start, end):
-                features, image_feature, labels = self.dataset[i]
-                all_features.append(features)
-                image_features.append(image_feature)
-                all_labels.append(labels)
-            x_features, x_image = pd.DataFrame(all_features, columns=self.dataset._feature_header), pd.DataFrame(image_features)
-            y = pd.DataFrame(all_labels, columns=self.dataset._label_header)
+            x_features, x_image, y = self._load_numpy(rows)
+            if end >= self.data_size:
+                if self.dataset.cache is not None:
+                    self.dataset.cache.flush()
+                self.close()
+            self.start = end
+            if self.return_numpy:
+                if self.return_labels:
+                    label_idx = [self.dataset._label_header.get_loc(label) for label in self.return_labels]
+                    if len(label_idx) > 1:
+                        y = y[:, label_idx]
+                    else:
+                        y = y[:, label_idx[0]]
+                return x_features, x_image, y
+            # DataFrames are built on top of the filled arrays, without another copy of the images
+            x_features = pd.DataFrame(x_features, columns=self.dataset._feature_header)
+            x_image = pd.DataFrame(x_image)
+            y = pd.DataFrame(y, columns=self.dataset._label_header)
             if self.return_labels:
                 if len(self.return_labels) > 1:
                     y = y[self.return_labels]
                 else:
                     y = y[self.return_labels[0]]
-            self.start = end
             return x_features, x_image, y
 
+
+def concat_features(x_features, x_image):
+    """Join the features and image columns of a batch into one model input.
+
+    Views returned by a BatchLoader with return_numpy are joined without copying.
+
+    Args:
+        x_features: Features of the batch.
+        x_image: Image columns of the batch.
+
+    Returns:
+        X: np.array if both inputs are arrays, else Pandas DataFrame
+    """
+    if isinstance(x_features, np.ndarray) and isinstance(x_image, np.ndarray):
+        data = x_features.base
+        if (data is not None and data is x_image.base and data.ndim == 2
+                and data.shape == (len(x_features), x_features.shape[1] + x_image.shape[1])
+                and x_features.__array_interface__['data'][0] == data.__array_interface__['data'][0]):
+            return data
+        return np.hstack([x_features, x_image])
+    return pd.concat([pd.DataFrame(x_features), pd.DataFrame(x_image)], axis=1)
+
+
+class PrefetchLoader:
+    """Iterate over a loader while the next batches are built on a background thread.
+
+    Args:
+        loader (BatchLoader): Loader to prefetch batches from.
+        depth (int): Maximum number of batches built ahead of the consumer.
+    """
+    _done = object()
+
+    def __init__(self, loader, depth):
+        self.loader = loader
+        self.depth = depth
+        self._queue = None
+        self._stop = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.close()
+        # Bounded queue, so at most depth batches are held in memory
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        # The thread only holds the loader and the queue, so an abandoned PrefetchLoader is still collected
+        # and its __del__ stops the thread
+        self._thread = threading.Thread(target=self._produce, args=(self.loader, self._queue, self._stop),
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __next__(self):
+        if self._queue is None:
+            raise StopIteration
+        item = self._queue.get()
+        if item is self._done:
+            self._thread.join()
+            self._queue = None
+            raise StopIteration
+        if isinstance(item, BaseException):
+            self._thread.join()
+            self._queue = None
+            raise item
+        return item
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the background thread if the consumer stops before the last batch."""
+        if self._thread is not None and self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self.loader.close()
+        self._thread = None
+        self._queue = None
+
+    @staticmethod
+    def _produce(loader, batches, stop):
+        try:
+            for batch in loader:
+                if not PrefetchLoader._put(batches, stop, batch):
+                    return
+            item = PrefetchLoader._done
+        except Exception as e:
+            # Errors are handed to the consumer and raised there
+            item = e
+        PrefetchLoader._put(batches, stop, item)
+
+    @staticmethod
+    def _put(batches, stop, item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
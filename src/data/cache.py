@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def transformation_key(transformations, proc_module='skimage'):
+    """Hash a transformation list into a short key that is stable across runs.
+
+    Args:
+        transformations (list): list of image transformations and their arguments.
+        proc_module (str, optional): Image processing module used for the transformations. Defaults to 'skimage'.
+
+    Returns:
+        str: Hex digest identifying the transformations.
+    """
+    spec = [proc_module, [[trans, args] for trans, args in transformations]]
+    spec = json.dumps(spec, sort_keys=True)
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()[:16]
+
+
+class ImageCache():
+    """ Persistent on-disk cache of transformed images backed by a memory-mapped array.
+
+        Images are appended to a flat binary file and looked up by their path through an
+        append-only index file, so the cache can be shared by several datasets and grows
+        as new images are read. The cache is keyed by a hash of the transformations,
+        hence only deterministic transformations may be cached. Only one process
+        should write to a cache directory at a time. Every index entry is written right
+        after its row, so a crash loses at most the image being written.
+
+        Args:
+            cache_dir (string): Base directory for the cache.
+            transformations (list): list of deterministic image transformations and their arguments.
+            proc_module (str, optional): Image processing module used for the transformations. Defaults to 'skimage'.
+            dtype (str, optional): Storage dtype, 'float16' or 'uint8'. 'uint8' only stores uint8 images. Defaults to 'float16'.
+    """
+    def __init__(self, cache_dir, transformations, proc_module='skimage', dtype='float16'):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float16, np.uint8):
+            raise ValueError(f'Unsupported cache dtype {dtype}, use float16 or uint8')
+        key = transformation_key(transformations, proc_module)
+        self.path = os.path.join(cache_dir, 'images', f'{key}_{self.dtype.name}')
+        os.makedirs(self.path, exist_ok=True)
+        self._data_file = os.path.join(self.path, 'images.dat')
+        self._index_file = os.path.join(self.path, 'index.txt')
+        self._meta_file = os.path.join(self.path, 'meta.json')
+        self.shape = None
+        self.image_dtype = None
+        self.index = {}
+        self.readonly = False
+        self._mmap = None
+        self._writer = None
+        self._index_writer = None
+
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, 'r') as file:
+                meta = json.load(file)
+            self.shape = tuple(meta['shape'])
+            self.image_dtype = np.dtype(meta['image_dtype'])
+        if os.path.exists(self._index_file):
+            with open(self._index_file, 'rb+') as file:
+                entries = file.read()
+                complete = entries.rfind(b'\n') + 1
+                if complete < len(entries):
+                    # A line cut short by a crash is dropped, its image is written again
+                    file.truncate(complete)
+            for line in entries[:complete].decode('utf-8').split('\n')[:-1]:
+                row, path = line.split('\t', 1)
+                self.index[path] = int(row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getstate__(self):
+        # Open file handles and memory maps are re-created on demand after unpickling
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        state['_writer'] = None
+        state['_index_writer'] = None
+        return state
+
+    def get(self, path):
+        """Read a cached image.
+
+        Args:
+            path (string): Image path the image was cached under.
+
+        Returns:
+            np.array: The transformed image with its original dtype.
+        """
+        row = self.index[path]
+        if self._mmap is None or row >= len(self._mmap):
+            self._remap()
+        image = self._mmap[row]
+        return image.astype(self.image_dtype)
+
+    def put(self, path, image):
+        """Append a transformed image to the cache. Images already cached are skipped.
+
+        Args:
+            path (string): Image path to cache the image under.
+            image (np.array): The transformed image.
+
+        Returns:
+            np.array: The image as get reads it back, rounded to the storage dtype.
+        """
+        image = np.asarray(image)
+        stored = image.astype(self.dtype)
+        if self.readonly or path in self.index:
+            return stored.astype(image.dtype)
+        if self.shape is None:
+            if self.dtype == np.uint8 and image.dtype != np.uint8:
+                raise ValueError(f'uint8 cache cannot store {image.dtype} images without loss, use float16')
+            self.shape = image.shape
+            self.image_dtype = image.dtype
+            with open(self._meta_file, 'w') as file:
+                json.dump({'shape': list(self.shape), 'image_dtype': self.image_dtype.str}, file)
+        elif image.shape != self.shape:
+            raise ValueError(f'Image shape {image.shape} of {path} does not match cached shape {self.shape}')
+
+        if self._writer is None:
+            # Unbuffered, so datasets sharing the cache directory always see the current file size
+            self._writer = open(self._data_file, 'ab', buffering=0)
+            self._index_writer = open(self._index_file, 'ab', buffering=0)
+        row = os.fstat(self._writer.fileno()).st_size // self._row_bytes()
+        self._writer.write(stored.tobytes())
+        # The index entry is only written after its row, so it never points at a missing row
+        self._index_writer.write(f'{row}\t{path}\n'.encode('utf-8'))
+        self.index[path] = row
+        return stored.astype(self.image_dtype)
+
+    def flush(self):
+        """Make the written images and their index entries durable on disk."""
+        for writer in [self._writer, self._index_writer]:
+            if writer is not None:
+                os.fsync(writer.fileno())
+
+    def _row_bytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _remap(self):
+        if self._writer is not None:
+            self._writer.flush()
+        num_rows = os.path.getsize(self._data_file) // self._row_bytes()
+        self._mmap = np.memmap(self._data_file, dtype=self.dtype, mode='r', shape=(num_rows, *self.shape))
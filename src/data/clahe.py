@@ -0,0 +1,159 @@
+import numpy as np
+import tensorflow as tf
+
+# Grey levels of the histograms, images are equalised as uint8
+NUM_LEVELS = 256
+
+
+def _as_levels(images):
+    # uint8 images are used as they are, float images are in [0, 1]
+    if images.dtype == np.uint8:
+        return images
+    return np.clip(np.rint(images * (NUM_LEVELS - 1)), 0, NUM_LEVELS - 1).astype(np.uint8)
+
+
+def _tile_size(height, width, kernel_size):
+    # Like equalize_adapthist, the default tiles are an eighth of the image along each axis
+    if kernel_size is None:
+        kernel_size = (height // 8, width // 8)
+    return max(min(kernel_size[0], height), 1), max(min(kernel_size[1], width), 1)
+
+
+def _neighbours(length, kernel, tiles):
+    # Centres of the two tiles around every pixel along an axis, and the weight of the second one
+    position = (np.arange(length) - (kernel - 1) / 2) / kernel
+    low = np.floor(position)
+    weight = (position - low).astype(np.float32)
+    low = low.astype(np.intp)
+    return np.clip(low, 0, tiles - 1), np.clip(low + 1, 0, tiles - 1), weight
+
+
+def clahe(images, kernel_size=None, clip_limit=0.03):
+    """Contrast limited adaptive histogram equalisation of an image or a stacked batch of images.
+
+    The images are split into tiles of kernel_size, padded by reflection at the bottom and right
+    edges. The histograms of all the tiles of the batch are counted by one bincount and clipped at
+    clip_limit of the tile size, the excess being spread over all the levels. The cumulative
+    histograms give one lookup table per tile, and every pixel is mapped by bilinear interpolation
+    of the lookup tables of the four nearest tile centres.
+
+    Args:
+        images (np.array): uint8 image or images stacked along the first axis, or floats in [0, 1].
+        kernel_size (tuple, optional): Height and width of the tiles. Defaults to None, an eighth of the image.
+        clip_limit (float, optional): Clipping limit as a fraction of the tile size, 0 for no clipping. Defaults to 0.03.
+
+    Returns:
+        np.array: The equalised images, float32 in [0, 1].
+    """
+    levels = _as_levels(np.asarray(images))
+    single = levels.ndim == 2
+    if single:
+        levels = levels[np.newaxis]
+    num, height, width = levels.shape
+    tile_height, tile_width = _tile_size(height, width, kernel_size)
+    tiles_y = -(-height // tile_height)
+    tiles_x = -(-width // tile_width)
+    padded = np.pad(levels, ((0, 0), (0, tiles_y * tile_height - height), (0, tiles_x * tile_width - width)),
+                    mode='reflect')
+
+    # Pixels of each tile in a row, the levels of every tile counted in bins of their own
+    tiles = padded.reshape(num, tiles_y, tile_height, tiles_x, tile_width).transpose(0, 1, 3, 2, 4)
+    tiles = tiles.reshape(-1, tile_height * tile_width)
+    bins = tiles + np.arange(len(tiles))[:, np.newaxis] * NUM_LEVELS
+    hist = np.bincount(bins.ravel(), minlength=len(tiles) * NUM_LEVELS).reshape(-1, NUM_LEVELS)
+    hist = hist.astype(np.float32)
+
+    pixels = tile_height * tile_width
+    if clip_limit > 0:
+        limit = max(int(clip_limit * pixels), 1)
+        clipped = np.minimum(hist, limit)
+        hist = clipped + (hist - clipped).sum(axis=1, keepdims=True) / NUM_LEVELS
+    luts = np.minimum(np.cumsum(hist, axis=1) / np.float32(pixels), 1).ravel()
+
+    top, bottom, weight_y = _neighbours(height, tile_height, tiles_y)
+    left, right, weight_x = _neighbours(width, tile_width, tiles_x)
+    # Offsets of the lookup tables in luts, for each image, row and column
+    image_offset = (np.arange(num) * tiles_y * tiles_x)[:, np.newaxis, np.newaxis]
+    top, bottom = top[:, np.newaxis] * tiles_x, bottom[:, np.newaxis] * tiles_x
+    weight_y = weight_y[:, np.newaxis]
+
+    def lookup(row, column):
+        return luts[(image_offset + row + column) * NUM_LEVELS + levels]
+
+    upper = lookup(top, left) * (1 - weight_x) + lookup(top, right) * weight_x
+    lower = lookup(bottom, left) * (1 - weight_x) + lookup(bottom, right) * weight_x
+    result = upper * (1 - weight_y) + lower * weight_y
+    return result[0] if single else result
+
+
+def tf_clahe(images, kernel_size=None, clip_limit=0.03):
+    """Graph version of clahe, for an image [height, width, channels] or a batch of images
+    [batch, height, width, channels]. Every channel is equalised on its own.
+
+    Args:
+        images (tf.Tensor): Images with values in [0, 255].
+        kernel_size (tuple, optional): Height and width of the tiles. Defaults to None, an eighth of the image.
+        clip_limit (float, optional): Clipping limit as a fraction of the tile size, 0 for no clipping. Defaults to 0.03.
+
+    Returns:
+        tf.Tensor: The equalised images, float32 in [0, 255] like tfa.image.equalize.
+    """
+    images = tf.convert_to_tensor(images)
+    single = images.shape.rank == 3
+    if single:
+        images = images[tf.newaxis]
+    shape = tf.shape(images)
+    num, height, width, channels = shape[0], shape[1], shape[2], shape[3]
+    # Channels are equalised as images of their own
+    levels = tf.transpose(images, [0, 3, 1, 2])
+    levels = tf.cast(tf.clip_by_value(tf.round(tf.cast(levels, tf.float32)), 0, NUM_LEVELS - 1), tf.int32)
+    levels = tf.reshape(levels, [-1, height, width])
+    count = num * channels
+
+    if kernel_size is None:
+        tile_height, tile_width = tf.maximum(height // 8, 1), tf.maximum(width // 8, 1)
+    else:
+        tile_height = tf.maximum(tf.minimum(kernel_size[0], height), 1)
+        tile_width = tf.maximum(tf.minimum(kernel_size[1], width), 1)
+    tiles_y = -(-height // tile_height)
+    tiles_x = -(-width // tile_width)
+    padded = tf.pad(levels, [[0, 0], [0, tiles_y * tile_height - height], [0, tiles_x * tile_width - width]],
+                    mode='REFLECT')
+
+    tiles = tf.reshape(padded, [count, tiles_y, tile_height, tiles_x, tile_width])
+    tiles = tf.reshape(tf.transpose(tiles, [0, 1, 3, 2, 4]), [-1, tile_height * tile_width])
+    num_tiles = tf.shape(tiles)[0]
+    bins = tiles + tf.range(num_tiles)[:, tf.newaxis] * NUM_LEVELS
+    hist = tf.math.bincount(tf.reshape(bins, [-1]), minlength=num_tiles * NUM_LEVELS,
+                            maxlength=num_tiles * NUM_LEVELS, dtype=tf.float32)
+    hist = tf.reshape(hist, [-1, NUM_LEVELS])
+
+    pixels = tf.cast(tile_height * tile_width, tf.float32)
+    if clip_limit > 0:
+        limit = tf.maximum(tf.floor(clip_limit * pixels), 1)
+        clipped = tf.minimum(hist, limit)
+        hist = clipped + tf.reduce_sum(hist - clipped, axis=1, keepdims=True) / NUM_LEVELS
+    luts = tf.reshape(tf.minimum(tf.cumsum(hist, axis=1) / pixels, 1), [-1])
+
+    def neighbours(length, kernel, tiles):
+        kernel = tf.cast(kernel, tf.float32)
+        position = (tf.range(length, dtype=tf.float32) - (kernel - 1) / 2) / kernel
+        low = tf.floor(position)
+        weight = position - low
+        low = tf.cast(low, tf.int32)
+        return tf.clip_by_value(low, 0, tiles - 1), tf.clip_by_value(low + 1, 0, tiles - 1), weight
+
+    top, bottom, weight_y = neighbours(height, tile_height, tiles_y)
+    left, right, weight_x = neighbours(width, tile_width, tiles_x)
+    image_offset = (tf.range(count) * tiles_y * tiles_x)[:, tf.newaxis, tf.newaxis]
+    top, bottom = top[:, tf.newaxis] * tiles_x, bottom[:, tf.newaxis] * tiles_x
+    weight_y = weight_y[:, tf.newaxis]
+
+    def lookup(row, column):
+        return tf.gather(luts, (image_offset + row + column) * NUM_LEVELS + levels)
+
+    upper = lookup(top, left) * (1 - weight_x) + lookup(top, right) * weight_x
+    lower = lookup(bottom, left) * (1 - weight_x) + lookup(bottom, right) * weight_x
+    result = (upper * (1 - weight_y) + lower * weight_y) * (NUM_LEVELS - 1)
+    result = tf.transpose(tf.reshape(result, [num, channels, height, width]), [0, 2, 3, 1])
+    return result[0] if single else result
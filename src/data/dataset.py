@@ -1,12 +1,18 @@
 import numpy as np
 import pandas as pd
-from src.data.batchloader import BatchLoader
+from src.data.batchloader import BatchLoader, PrefetchLoader
 from sklearn.utils.class_weight import compute_class_weight
 import matplotlib.pyplot as plt
+import hashlib
+import json
 import os
+import random
+import warnings
 
 
-from src.data.imgproc import get_proc_class
+from src.data.imgproc import get_proc_class, deterministic_length
+from src.data.cache import ImageCache
+from src.data.shards import ShardStore
 
 
 class ImageDataset():
@@ -18,6 +24,9 @@ class ImageDataset():
             proc_module (str, optional): [description]. Defaults to 'skimage'.
             transformations (list, optional): list of image transformations and their arguments. Defaults to [ ('resize', {'size': (320, 320)}), ('flatten', {}) ].
             limit (int, optional): Maxinum limit for loading the dataset. Defaults to None.
+            cache_dir (string, optional): Directory for the persistent cache of images transformed by the deterministic prefix of the transformations, and of the cleaned label table. Defaults to None, no caching.
+            cache_dtype (str, optional): Storage dtype of the image cache, 'float16' or 'uint8'. Defaults to 'float16'.
+            shard_dir (string, optional): Directory of image shards packed by make_dataset, read instead of the jpeg files. Its label sidecar is used if no labels are given. Defaults to None.
     """
     def __init__(self,
                  label_csv_path=None,
@@ -32,40 +41,221 @@ class ImageDataset():
                  map_option = None,
                  random_state = 2021,
                  limit = None,
-                 clean=True):
+                 clean=True,
+                 cache_dir=None,
+                 cache_dtype='float16',
+                 shard_dir=None):
         self.image_path_base = image_path_base
+        self.proc_module = proc_module
         self.imgproc = get_proc_class(proc_module)
         self.transformations = transformations
         self.map_option = map_option
         self.random_state = random_state
         self.limit = limit
-        if label_csv_path is not None:
-            self.df = pd.read_csv(label_csv_path)
-        elif label_df is not None:
-            self.df = label_df
-        else:
-            print('Either label_df or label_csv_path must be specified')
-        self._feature_header = self.df.columns[1:5]
-        self._label_header = self.df.columns[5::]
-        if limit is not None:
-            self.df = self.df.sample(n=limit, random_state=self.random_state)
-        self.df = self.df.reset_index(drop=True)
-        self._num_image = len(self.df)
+        self.cache_dir = cache_dir
+        self.cache_dtype = cache_dtype
+        self.shard_dir = shard_dir
+        self.shards = None
+        read_transformations = transformations
+        if shard_dir is not None:
+            self.shards = ShardStore(shard_dir, image_path_base)
+            # Transformations left after the ones applied when packing
+            read_transformations = self.shards.strip(transformations)
+            if label_csv_path is None and label_df is None:
+                label_csv_path = self.shards.label_csv_path
+        # Compiled once, invalid transformation arguments are raised here. The deterministic prefix
+        # is cached, the random suffix runs again every epoch with a generator seeded per image.
+        num_prefix = deterministic_length(read_transformations)
+        self._prefix = self.imgproc.compile(read_transformations[:num_prefix])
+        self._head = self.imgproc.compile(read_transformations[:min(num_prefix, 1)])
+        self._tail = self.imgproc.compile(read_transformations[1:num_prefix])
+        self._suffix = self.imgproc.compile(read_transformations[num_prefix:])
+        self.cache = None
+        if cache_dir is not None:
+            cached_transformations = transformations[:len(transformations) - len(read_transformations) + num_prefix]
+            if len(cached_transformations) > 0:
+                self.cache = ImageCache(cache_dir, cached_transformations, proc_module=proc_module,
+                                        dtype=cache_dtype)
+            else:
+                warnings.warn('Image cache disabled, the first transformation is random')
         self._frontal_only = frontal_only
-        if clean:
-            self.__clean__()
+        snapshot_path = None
+        if cache_dir is not None and label_csv_path is not None and clean:
+            snapshot_path = self.__snapshot_path__(label_csv_path)
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            # Cleaned label table of an earlier run
+            self.df = pd.read_feather(snapshot_path)
+            self._feature_header = self.df.columns[1:5]
+            self._label_header = self.df.columns[5::]
+        else:
+            if label_csv_path is not None:
+                self.df = pd.read_csv(label_csv_path)
+            elif label_df is not None:
+                self.df = label_df
+            else:
+                print('Either label_df or label_csv_path must be specified')
+            self._feature_header = self.df.columns[1:5]
+            self._label_header = self.df.columns[5::]
+            if limit is not None:
+                self.df = self.df.sample(n=limit, random_state=self.random_state)
+            self.df = self.df.reset_index(drop=True)
+            if clean:
+                self.__clean__()
+                self.__set_dtypes__()
+            if snapshot_path is not None:
+                self.__save_snapshot__(snapshot_path)
+        # Labels before mapping, kept for uncertain_views
+        self._uncertain_labels = self.df[self._label_header].to_numpy(dtype=np.int8)
         if self.map_option is not None:
             self.__map_uncertain__(option=self.map_option)
+        self._num_image = len(self.df)
+        self.__build_columns__()
 
     def __len__(self):
         return self._num_image
 
     def __getitem__(self, idx):
-        image = self.imgproc.imread(self.df['Path'].iloc[idx])
-        transformed = self.imgproc.transform(image, self.transformations)
-        features = self.df[self._feature_header].iloc[idx].values
-        labels = self.df[self._label_header ].iloc[idx].values
+        transformed = self.read_image(self._paths[idx])
+        features = self._features[idx]
+        labels = self._labels[idx]
         return (features, transformed, labels)
+
+    def __build_columns__(self):
+        """Materialise the paths, features and labels of df as compact arrays for fast indexing.
+        Called again by batchloader, load, features and labels, so they see the changes made to df.
+        """
+        self._paths = self.df['Path'].to_numpy(dtype=object)
+        self._features = self.df[self._feature_header].to_numpy(dtype=np.float32)
+        self._labels = self.df[self._label_header].to_numpy(dtype=np.int8)
+
+    def features(self):
+        """Tabular features of the images in the order of df, without reading any image.
+
+        Returns:
+            np.array: float32 feature matrix, one row per image.
+        """
+        self.__build_columns__()
+        return self._features.copy()
+
+    def labels(self, return_labels=None):
+        """Labels of the images in the order of df, without reading any image. The batchloader without shuffle,
+        load and the evaluation pipelines of tfpipeline read the images in the same order.
+
+        Args:
+            return_labels (list, optional): List of labels to be return. If value is None it will return all labels. Defaults to None.
+
+        Returns:
+            np.array: int8 label matrix, one row per image.
+        """
+        self.__build_columns__()
+        if return_labels is None:
+            return self._labels.copy()
+        columns = self._label_header.get_indexer(return_labels)
+        if (columns < 0).any():
+            raise KeyError(f'Unknown labels: {[label for label, column in zip(return_labels, columns) if column < 0]}')
+        return self._labels[:, columns]
+
+    def read_image(self, path, epoch=0):
+        """Read and transform one image, going through the image cache if enabled.
+
+        Args:
+            path (string): Path of the image file.
+            epoch (int, optional): Epoch seeding the random transformations. Defaults to 0.
+
+        Returns:
+            np.array: The transformed image.
+        """
+        if self.cache is not None and path in self.cache:
+            image = self.cache.get(path)
+        else:
+            if self.shards is not None:
+                image = self._prefix(self.shards.get(path))
+            else:
+                image = self._prefix.read(path)
+            if self.cache is not None:
+                # As read back from the cache, so the result does not depend on cache hits
+                image = self.cache.put(path, image)
+        if self._suffix.steps:
+            image = self._suffix(image, rng=self.__rng__(path, epoch))
+        return image
+
+    def read_images(self, paths, out=None, epoch=0):
+        """Read and transform a batch of images. Images of the same shape are stacked after the first
+        transformation, so the remaining deterministic transformations run once over the whole batch.
+
+        Args:
+            paths (list): Paths of the image files.
+            out (np.array, optional): Array of shape (len(paths), *image shape) to write the images into. Defaults to None.
+            epoch (int, optional): Epoch seeding the random transformations. Defaults to 0.
+
+        Returns:
+            np.array: The transformed images stacked along the first axis, out if given.
+        """
+        if not self._suffix.steps:
+            return self.__read_prefix__(paths, out)
+        images = self.__read_prefix__(paths)
+        if out is None:
+            return np.stack([self._suffix(image, rng=self.__rng__(path, epoch)) for path, image in zip(paths, images)])
+        for path, image, row in zip(paths, images, out):
+            self._suffix(image, out=row, rng=self.__rng__(path, epoch))
+        return out
+
+    def __rng__(self, path, epoch):
+        """Generator of the random transformations of an image, the same for an image and epoch
+        whatever the order, batch or process the image is read in.
+        """
+        return random.Random(f'{self.random_state}-{epoch}-{path}')
+
+    def __read_prefix__(self, paths, out=None):
+        """Read a batch of images transformed by the deterministic prefix, going through the image cache."""
+        cached = {}
+        missing = []
+        for i, path in enumerate(paths):
+            if self.cache is not None and path in self.cache:
+                cached[i] = self.cache.get(path)
+            else:
+                missing.append(i)
+        if not cached:
+            images = self.__read_batch__(paths, out)
+            self.__put__(paths, images)
+            return images
+        if missing:
+            images = self.__read_batch__([paths[i] for i in missing])
+            self.__put__([paths[i] for i in missing], images)
+            cached.update(zip(missing, images))
+        images = [cached[i] for i in range(len(paths))]
+        if out is None:
+            return np.stack(images)
+        for row, image in zip(out, images):
+            row[...] = image
+        return out
+
+    def __put__(self, paths, images):
+        """Write newly read images to the image cache. The images are rounded in place to the values read
+        back from the cache, so the results do not depend on cache hits.
+        """
+        if self.cache is not None:
+            for path, image in zip(paths, images):
+                image[...] = self.cache.put(path, image)
+
+    def __read_batch__(self, paths, out=None):
+        """Read a batch of images transformed by the deterministic prefix, without the image cache."""
+        if self.shards is not None:
+            return self._prefix.batch(np.stack([self.shards.get(path) for path in paths]), out=out)
+        if len(self._prefix.steps) == 1:
+            # A single (fused) step writes each image straight into the batch, e.g. crop, normalize and flatten
+            start = 0
+            if out is None:
+                first = self._prefix.read(paths[0])
+                out = np.empty((len(paths), *np.shape(first)), dtype=first.dtype)
+                out[0] = first
+                start = 1
+            for path, row in zip(paths[start:], out[start:]):
+                self._prefix.read(path, out=row)
+            return out
+        # The first transformation gives every image the same shape, e.g. crop or resize
+        stacked = np.stack([self._head.read(path) for path in paths])
+        return self._tail.batch(stacked, out=out)
     
     def __clean__(self):
         """"Perform basic data cleaning
@@ -83,86 +273,165 @@ class ImageDataset():
         self.df['AP/PA'] = self.df['AP/PA'].replace(np.nan, 1)
         # Replace np.nan with 0
         self.df[self._label_header] = self.df[self._label_header].replace(np.nan, 0)
-        self.df.reset_index(drop=True)
+        self.df = self.df.reset_index(drop=True)
         self._num_image = len(self.df)
 
+    def __set_dtypes__(self):
+        """Store the cleaned features and labels with compact dtypes.
+        """
+        flag_columns = ['Sex', 'Frontal/Lateral', 'AP/PA']
+        self.df[flag_columns] = self.df[flag_columns].astype(np.int8)
+        self.df['Age'] = self.df['Age'].astype(np.float32)
+        self.df[self._label_header] = self.df[self._label_header].astype(np.int8)
+
+    def __snapshot_path__(self, label_csv_path):
+        """Path of the cleaned label table snapshot, keyed by the csv file and every option changing the table.
+        The uncertain labels are mapped after loading, so the snapshot is shared by all mapping options.
+        """
+        stat = os.stat(label_csv_path)
+        spec = [os.path.abspath(label_csv_path), stat.st_mtime_ns, stat.st_size, self.image_path_base,
+                self._frontal_only, self.limit, self.random_state]
+        key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'labels', f'{key}.feather')
+
+    def __save_snapshot__(self, snapshot_path):
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        # Write to a temporary file first, so a partly written snapshot is never read
+        tmp_path = f'{snapshot_path}.tmp'
+        self.df.to_feather(tmp_path)
+        os.replace(tmp_path, snapshot_path)
+
     def __map_uncertain__(self, option):
-        """"Map the uncertain label of -1 to [0,1] depending on mapping option, replace np.nan with 0.
+        """"Map the uncertain label of -1 to [0,1] depending on mapping option.
 
         Args:
             option : str or dict of column label uncertain approach. Options value can be 'U-zero', 'U-one' and 'Random'
         """
-        map_dict = {
-            'U-zero':
-                {
-                    1.0: 1.0,
-                    '': 0.0,
-                    0.0: 0.0,
-                    -1.0: 0.0
-                },
-            'U-one':
-                {
-                    1.0: 1.0,
-                    '': 0.0,
-                    0.0: 0.0,
-                    -1.0: 1.0
-                }
-        }
+        self.df[self._label_header] = self.__mapped_labels__(self._uncertain_labels, option)
 
-        op_dict = option
+    def __mapped_labels__(self, labels, option):
+        """Map the uncertain labels of all label columns in one vectorised pass.
+
+        'Random' draws 1 with the probability of a positive label in the column, from a
+        generator seeded with random_state.
 
+        Args:
+            labels (np.array): int8 label matrix with -1 for uncertain labels.
+            option : str or dict of column label uncertain approach. Options value can be 'U-zero', 'U-one' and 'Random'
+
+        Returns:
+            np.array: Mapped int8 label matrix.
+        """
+        op_dict = option
         if type(option) == str:
-            op_dict = {col:option for col in self._label_header} 
-
-        columns = list(op_dict.keys())
-
-        for col, opt in op_dict.items():
-            if opt == 'U-zero' or opt == 'U-one':
-                self.df[col] = self.df[col].map(map_dict[opt])
-            elif opt == 'Random':
-                sum_positive = (self.df[col] == 1.0).sum()
-                sum_negative = (self.df[col] == 0.0).sum()
-                prob_positive = sum_positive / (sum_positive + sum_negative)
-                list_size = self.df[self.df[col] == -1.0][col].size
-                
-                random_list = np.random.choice(a=[0, 1], p=[1 - prob_positive, prob_positive], size=list_size)
-                self.df.loc[self.df[col] == -1.0, col] = random_list
+            op_dict = {col: option for col in self._label_header}
+        column_options = np.array([op_dict.get(col) for col in self._label_header])
+
+        num_positive = (labels == 1).sum(axis=0)
+        num_negative = (labels == 0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prob_positive = np.nan_to_num(num_positive / (num_positive + num_negative))
+        rng = np.random.default_rng(self.random_state)
+        random_labels = (rng.random(labels.shape) < prob_positive).astype(np.int8)
+
+        mapped_labels = np.where(column_options == 'U-one', np.int8(1),
+                                 np.where(column_options == 'Random', random_labels, np.int8(0)))
+        is_mapped = (labels == -1) & np.isin(column_options, ['U-zero', 'U-one', 'Random'])
+        return np.where(is_mapped, mapped_labels, labels).astype(np.int8)
+
+    def uncertain_views(self, options=('U-zero', 'U-one', 'Random')):
+        """Datasets with the uncertain labels mapped by each option, without reading the labels again.
+
+        Args:
+            options (list, optional): str mapping options. Defaults to ('U-zero', 'U-one', 'Random').
+
+        Returns:
+            dict: ImageDataset for each option, sharing the image cache of this dataset.
+        """
+        views = {}
+        for option in options:
+            df = self.df.copy()
+            df[self._label_header] = self.__mapped_labels__(self._uncertain_labels, option)
+            view = ImageDataset(label_df=df, image_path_base=self.image_path_base, proc_module=self.proc_module,
+                                transformations=self.transformations, frontal_only=self._frontal_only,
+                                random_state=self.random_state, clean=False)
+            view.map_option = option
+            view.cache_dir = self.cache_dir
+            view.cache_dtype = self.cache_dtype
+            view.cache = self.cache
+            view.shard_dir = self.shard_dir
+            view.shards = self.shards
+            view._prefix, view._head, view._tail, view._suffix = self._prefix, self._head, self._tail, self._suffix
+            view._uncertain_labels = self._uncertain_labels
+            views[option] = view
+        return views
 
     def split(self, validsize, transformations=None):
         self.valid_df = self.df.sample(n=round(validsize*self.df.shape[0]), random_state=self.random_state)
+        # Labels before mapping of both parts, for uncertain_views
+        positions = self.df.index.get_indexer(self.valid_df.index)
+        valid_uncertain_labels = self._uncertain_labels[positions]
+        self._uncertain_labels = np.delete(self._uncertain_labels, positions, axis=0)
         self.df = (self.df.drop(self.valid_df.index)
                           .reset_index(drop=True))
         self._num_image = len(self.df)
+        self.__build_columns__()
         self.valid_df = self.valid_df.reset_index(drop=True)
         if transformations is None:
             transformations = self.transformations
 
-        return ImageDataset(label_df=self.valid_df, image_path_base=self.image_path_base,
-                            transformations=transformations, map_option=self.map_option,
-                            frontal_only=self._frontal_only, clean=False)
+        valid_dataset = ImageDataset(label_df=self.valid_df, image_path_base=self.image_path_base,
+                                     proc_module=self.proc_module, transformations=transformations,
+                                     map_option=self.map_option, frontal_only=self._frontal_only, clean=False,
+                                     cache_dir=self.cache_dir, cache_dtype=self.cache_dtype, shard_dir=self.shard_dir)
+        valid_dataset._uncertain_labels = valid_uncertain_labels
+        return valid_dataset
 
-    def batchloader(self, batch_size, return_labels=None, without_image=False, return_X_y=True):
+    def batchloader(self, batch_size, return_labels=None, without_image=False, return_X_y=True, num_workers=0,
+                    prefetch=0, return_numpy=False, shuffle=False, seed=None, shard=None, epoch=0):
         """Loader for loading dataset in batch.
 
         Args:
             batch_size (int): Size for one batch.
             return_labels ([list, optional): List of labels to be return. If value is None it will return all labels. Defaults to None.
+            num_workers (int, optional): Number of worker processes to load each batch with. Defaults to 0, load in the main process.
+            prefetch (int, optional): Number of batches to build ahead on a background thread. Defaults to 0, no prefetching.
+            return_numpy (bool, optional): Return float32 views of one preallocated array and a label array instead of DataFrames. Defaults to False.
+            shuffle (bool, optional): Iterate in a new random order every epoch, without copying df. Defaults to False.
+            seed (int, optional): Seed of the shuffled order of each epoch. Defaults to None, use random_state.
+            shard (tuple, optional): (index, count) to only load shard index out of count disjoint shards. Defaults to None, load all rows.
+            epoch (int, optional): Epoch of the first iteration, seeding the shuffled order and the random transformations. Every iteration of the loader is the next epoch, a new loader for a later epoch must be given it. Defaults to 0.
 
         Returns:
             BatchLoader: a literator.
         """
-        return BatchLoader(self, batch_size, return_labels, without_image=without_image, return_X_y=return_X_y)
+        self.__build_columns__()
+        loader = BatchLoader(self, batch_size, return_labels, without_image=without_image, return_X_y=return_X_y,
+                             num_workers=num_workers, return_numpy=return_numpy, shuffle=shuffle, seed=seed,
+                             epoch=epoch)
+        if shard is not None:
+            loader.shard(*shard)
+        if prefetch > 0:
+            loader = PrefetchLoader(loader, prefetch)
+        return loader
 
-    def load(self, return_labels=None, without_image=False, return_X_y=True):
+    def load(self, return_labels=None, without_image=False, return_X_y=True, num_workers=0, return_numpy=False,
+             dtype='float32'):
         """Load the entire dataset.
 
         Args:
             return_labels ([list, optional): List of labels to be return. If value is None it will return all labels. Defaults to None.
+            num_workers (int, optional): Number of worker processes to load the dataset with. Defaults to 0, load in the main process.
+            return_numpy (bool, optional): Return views of one preallocated array and a label array instead of DataFrames. Defaults to False.
+            dtype (str, optional): Dtype the images are stored with, 'float32', 'float16' or 'uint8'. 'uint8' requires uint8 images, e.g. no normalize step. Defaults to 'float32'.
 
         Returns:
-            X, y: Pandas DataFrame
+            X, y: Pandas DataFrame, or np.array with return_numpy
         """
-        return next(iter(BatchLoader(self, self._num_image, return_labels, without_image=without_image, return_X_y=return_X_y)))
+        self.__build_columns__()
+        return next(iter(BatchLoader(self, self._num_image, return_labels, without_image=without_image,
+                                     return_X_y=return_X_y, num_workers=num_workers, return_numpy=return_numpy,
+                                     dtype=dtype)))
 
     def get_class_weights(self, return_labels=None):
         """"Get the class weights.
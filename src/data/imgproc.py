@@ -1,8 +1,50 @@
 from abc import ABC, abstractmethod
+import hashlib
+import inspect
+import os
 import numpy as np
 import tensorflow as tf
+from src.data.cache import transformation_key
+
+# Transformations that draw a random value when the named argument is not given
+RANDOM_TRANSFORMATIONS = {
+    'rotate': 'degree',
+    'zoom': 'percentage'
+}
+
+
+def deterministic_length(transformations):
+    """Length of the longest prefix of a list of transformations that always gives the same output for the same image.
+
+    Args:
+        transformations (list): list of image transformations and their arguments.
+
+    Returns:
+        int: Number of transformations before the first one drawing a random value.
+    """
+    for i, (trans, args) in enumerate(transformations):
+        if trans in RANDOM_TRANSFORMATIONS and args.get(RANDOM_TRANSFORMATIONS[trans]) is None:
+            return i
+    return len(transformations)
+
+
+def is_deterministic(transformations):
+    """Check whether a list of transformations always gives the same output for the same image.
+
+    Args:
+        transformations (list): list of image transformations and their arguments.
+
+    Returns:
+        bool: True if none of the transformations draws a random value.
+    """
+    return deterministic_length(transformations) == len(transformations)
+
 
 class ImageProcessing(ABC):
+    # Adjacent transformations run by one method in a compiled Pipeline, as (names, method), longest first
+    fusions = []
+    # Whether the transformations also take a stacked batch of images when there is no <name>_batch method
+    batch_native = False
 
     def __init__(self) -> None:
         super().__init__()
@@ -19,11 +61,186 @@ class ImageProcessing(ABC):
         flatted = np.ndarray.flatten(image)
         return flatted
 
+    def flatten_batch(self, images):
+        return images.reshape(len(images), -1)
+
     def transform(self, image, transformations):
         for trans, args in transformations:
             image = getattr(self, trans)(image, **args)
         return image
 
+    def transform_batch(self, images, transformations):
+        """Apply the transformations to a stacked batch of images, each transformation at once
+        for the whole batch. Transformations without a <name>_batch method run image by image.
+        The results are the same as transforming every image on its own.
+
+        Args:
+            images (np.array): Images stacked along the first axis.
+            transformations (list): list of image transformations and their arguments.
+
+        Returns:
+            np.array: The transformed images.
+        """
+        for trans, args in transformations:
+            batch_trans = getattr(self, f'{trans}_batch', None)
+            if batch_trans is None and self.batch_native:
+                batch_trans = getattr(self, trans)
+            if batch_trans is not None:
+                images = batch_trans(images, **args)
+            else:
+                images = np.stack([getattr(self, trans)(image, **args) for image in images])
+        return images
+
+    def imread_args(self, transformations):
+        """Arguments of imread for images transformed by the transformations, e.g. to decode more cheaply."""
+        return {}
+
+    def read(self, path, transformations):
+        """Read an image and apply the transformations.
+
+        Args:
+            path (string): Path of the image file.
+            transformations (list): list of image transformations and their arguments.
+
+        Returns:
+            The transformed image.
+        """
+        return self.transform(self.imread(path, **self.imread_args(transformations)), transformations)
+
+    def compile(self, transformations):
+        """Compile the transformations into a Pipeline run by this backend.
+
+        Args:
+            transformations (list): list of image transformations and their arguments.
+
+        Returns:
+            Pipeline: The compiled transformations.
+        """
+        return Pipeline(self, transformations)
+
+
+class Pipeline():
+    """ Transformations compiled once for an image processing backend.
+
+        The arguments of every transformation are checked when compiling. Adjacent transformations
+        listed in the fusions of the backend run as one step, and the last step can write into a
+        preallocated output array.
+
+        Args:
+            imgproc (ImageProcessing): Backend running the transformations.
+            transformations (list): list of image transformations and their arguments.
+    """
+    def __init__(self, imgproc, transformations):
+        self.imgproc = imgproc
+        self.transformations = [(trans, dict(args)) for trans, args in transformations]
+        for trans, args in self.transformations:
+            method = getattr(imgproc, trans, None)
+            if method is None:
+                raise ValueError(f'Unknown transformation {trans} for {type(imgproc).__name__}')
+            try:
+                inspect.signature(method).bind(None, **args)
+            except TypeError as e:
+                raise ValueError(f'Invalid arguments {args} for transformation {trans}: {e}') from None
+        self.imread_args = imgproc.imread_args(self.transformations)
+
+        self.steps = []
+        self.batch_steps = []
+        for name, args in self.__fuse__():
+            method = getattr(imgproc, name)
+            params = inspect.signature(method).parameters
+            self.steps.append((method, args, 'out' in params, 'rng' in params))
+            batch_method = getattr(imgproc, f'{name}_batch', None)
+            if batch_method is None and imgproc.batch_native:
+                batch_method = method
+            if batch_method is None:
+                self.batch_steps.append((self.__per_image__(method), args, False, False))
+            else:
+                self.batch_steps.append((batch_method, args, 'out' in inspect.signature(batch_method).parameters,
+                                         False))
+
+    def __getstate__(self):
+        # Steps hold bound methods and closures, they are compiled again after unpickling
+        return {'imgproc': self.imgproc, 'transformations': self.transformations}
+
+    def __setstate__(self, state):
+        self.__init__(state['imgproc'], state['transformations'])
+
+    def __fuse__(self):
+        """Names and merged arguments of the methods running the transformations."""
+        names = [trans for trans, _ in self.transformations]
+        steps = []
+        i = 0
+        while i < len(names):
+            for fused_names, fused in self.imgproc.fusions:
+                if tuple(names[i:i + len(fused_names)]) == tuple(fused_names):
+                    args = {}
+                    for _, step_args in self.transformations[i:i + len(fused_names)]:
+                        args.update(step_args)
+                    steps.append((fused, args))
+                    i += len(fused_names)
+                    break
+            else:
+                steps.append(self.transformations[i])
+                i += 1
+        return steps
+
+    @staticmethod
+    def __per_image__(method):
+        def run(images, **args):
+            return np.stack([method(image, **args) for image in images])
+        return run
+
+    @staticmethod
+    def __run__(image, steps, out, rng=None):
+        for i, (method, args, takes_out, takes_rng) in enumerate(steps):
+            if rng is not None and takes_rng:
+                args = dict(args, rng=rng)
+            if out is not None and takes_out and i == len(steps) - 1:
+                return method(image, out=out, **args)
+            image = method(image, **args)
+        if out is not None:
+            out[...] = np.reshape(image, out.shape)
+            return out
+        return image
+
+    def __call__(self, image, out=None, rng=None):
+        """Transform an image.
+
+        Args:
+            image: The image.
+            out (np.array, optional): Array of the size of the transformed image to write it into. Defaults to None.
+            rng (random.Random, optional): Generator of the random transformations. Defaults to None, the global random.
+
+        Returns:
+            The transformed image, out if given.
+        """
+        return self.__run__(image, self.steps, out, rng)
+
+    def batch(self, images, out=None):
+        """Transform a stacked batch of images, each step at once for the whole batch where the
+        backend has a <name>_batch method.
+
+        Args:
+            images (np.array): Images stacked along the first axis.
+            out (np.array, optional): Array of the size of the transformed images to write them into. Defaults to None.
+
+        Returns:
+            np.array: The transformed images, out if given.
+        """
+        return self.__run__(images, self.batch_steps, out)
+
+    def read(self, path, out=None):
+        """Read an image and transform it.
+
+        Args:
+            path (string): Path of the image file.
+            out (np.array, optional): Array of the size of the transformed image to write it into. Defaults to None.
+
+        Returns:
+            The transformed image, out if given.
+        """
+        return self(self.imgproc.imread(path, **self.imread_args), out=out)
+
 def get_proc_class(module_name):
     if module_name == 'skimage':
         from .imgproc_skimage import SKImageProcessing
@@ -31,30 +248,193 @@ def get_proc_class(module_name):
     elif module_name == 'tfimage':
         from .imgproc_skimage import TfImageProcessing
         return TfImageProcessing()
+    elif module_name == 'cv2':
+        from .imgproc_cv2 import CV2ImageProcessing
+        return CV2ImageProcessing()
     else:
         raise Exception(f'Unkown module name {module_name} for image process class')
 
-def tf_read_image(x_features, filename, label, cnn_model,
+def tf_read_image(x_features, filename, label,
                   channels=1, proc_module='tfimage',
                   transformations=[
-                      ('resize', {'size': (320, 320)},
-                       ('normalize', {}))
+                      ('resize', {'size': (320, 320)}),
+                      ('normalize', {})
                   ]):
     image_string = tf.io.read_file(filename)
+    pipeline = get_proc_class(proc_module).compile(transformations)
+
+    # A leading crop only decodes the cropped window
+    image = pipeline.imgproc.decode(image_string, channels=channels, **pipeline.imread_args)
+    image = pipeline(image)
+
+    x_features = tf.reshape(x_features, [x_features.shape[0]])
+    label = tf.reshape(label, [label.shape[0]])
+    return (x_features, image), label
+
+
+def tf_read_shard(x_features, row, label, shards,
+                  proc_module='tfimage',
+                  transformations=[
+                      ('crop', {'size': (320, 320)}),
+                      ('normalize', {})
+                  ]):
+    """Read an image from the shards packed by make_dataset, the counterpart of tf_read_image.
+
+    Args:
+        row: Row of the image in the shards, from ShardStore.rows.
+        shards (ShardStore): Shards to read the image from.
+    """
     imgproc = get_proc_class(proc_module)
 
-    #Don't use tf.image.decode_image, or the output shape will be undefined
-    image = tf.io.decode_jpeg(image_string, channels=channels)
-    image = imgproc.transform(image, transformations)
-
-    if cnn_model in ["MobileNetv2_keras",
-                     "MobileNetv2_pop1",
-                     "MobileNetv2_pop2",
-                     "DenseNet121_keras",
-                     "ResNet152_keras"]:
-        image = tf.image.grayscale_to_rgb(image)
-        #image = tf.reshape(image, [image.shape[0], image.shape[1], 3])
+    # The shards are memory-mapped, reading an image is a copy instead of a jpeg decode
+    image = tf.numpy_function(shards.read, [row], tf.uint8)
+    image = tf.reshape(image, [*shards.shape, 1])
+    # Cropping in the tfimage backend returns float32
+    image = tf.cast(image, tf.float32)
+    image = imgproc.compile(shards.strip(transformations))(image)
+
     x_features = tf.reshape(x_features, [x_features.shape[0]])
     label = tf.reshape(label, [label.shape[0]])
     return (x_features, image), label
 
+
+def tf_read_batches(tfds, batch_size, shards=None,
+                    channels=1, proc_module='tfimage', image_dtype='float32',
+                    cache_dir=None, cache_key='data', shuffle=False, shuffle_buffer=1024, repeat=False, seed=None,
+                    num_parallel_reads=tf.data.AUTOTUNE,
+                    transformations=[
+                        ('crop', {'size': (320, 320)}),
+                        ('normalize', {})
+                    ]):
+    """Read the images of a tf.data pipeline in batches, the batched counterpart of tf_read_image and tf_read_shard.
+
+    Jpeg files are decoded one by one, with the leading crop or resize giving all the images the same size, a crop
+    only decoding its window. The images are then batched, and the other transformations run once for each
+    [batch, height, width, channels] tensor in the traced map functions. With shards, whole batches of rows are
+    read at once.
+    The transformations are compiled once here instead of every time a map function is traced.
+
+    With image_dtype 'uint8' the images stay uint8, a quarter of the float32 size. The normalize transformation is
+    skipped, the models scale the images in their preprocess_image layers instead.
+
+    With cache_dir the elements are cached on disk after the deterministic transformations, and the random ones
+    run on the cached images. The cache is written during the first full pass over the pipeline and read in
+    the same order by every later pass, even of a new pipeline. With shuffle the elements are shuffled once with
+    the seed before they are cached, so the cache file is in a random order, and then in a buffer after the cache.
+    uint8 images are rounded before the cache, and otherwise once after all the transformations.
+
+    With shuffle and repeat the pipeline can be built once for a whole training: every pass is reshuffled,
+    and model.fit takes its steps_per_epoch from the repeated batches.
+
+    Args:
+        tfds (tf.data.Dataset): Elements of features, image path or row in the shards, and label.
+        batch_size (int): Batch size.
+        shards (ShardStore, optional): Shards to read the rows from. Defaults to None, reading jpeg files.
+        channels (int, optional): Channels of the images, 3 for models taking rgb images. Defaults to 1.
+        proc_module (str, optional): Image processing backend. Defaults to 'tfimage'.
+        image_dtype (str, optional): 'float32' for normalized images, or 'uint8'. Defaults to 'float32'.
+        cache_dir (string, optional): Base directory for the cache. Defaults to None, no caching.
+        cache_key (string, optional): Name of the cache of these elements, e.g. from tf_cache_key. Defaults to 'data'.
+        shuffle (bool, optional): Reshuffle the elements on every pass, all at once before reading them, or in a
+            buffer after the cache of the elements shuffled once. Defaults to False.
+        shuffle_buffer (int, optional): Size of the buffer shuffling the cached elements. Defaults to 1024.
+        repeat (bool, optional): Repeat the passes over the elements indefinitely. Defaults to False.
+        seed (int, optional): Seed of the shuffling. Defaults to None.
+        num_parallel_reads (int, optional): Images or batches of rows read in parallel. Defaults to tf.data.AUTOTUNE.
+        transformations (list, optional): list of image transformations and their arguments.
+
+    Returns:
+        tf.data.Dataset: Batches of ((features, images), labels).
+    """
+    imgproc = get_proc_class(proc_module)
+    if image_dtype == 'uint8':
+        # The other transformations give the same images on the [0, 255] scale
+        transformations = [(trans, args) for trans, args in transformations if trans != 'normalize']
+    if shuffle:
+        # Only features, paths or rows and labels are held in the shuffle buffer, the cache is written in the
+        # order of the first pass
+        num_elements = int(tfds.cardinality())
+        tfds = tfds.shuffle(num_elements if num_elements > 0 else shuffle_buffer, seed=seed,
+                            reshuffle_each_iteration=cache_dir is None)
+
+    if shards is None:
+        if len(transformations) == 0 or transformations[0][0] not in ['crop', 'resize']:
+            raise ValueError(f'Transformations {transformations} must start with crop or resize to be batched')
+        head = imgproc.compile(transformations[:1])
+        batch_transformations = transformations[1:]
+
+        def read(x_features, filename, label):
+            image = imgproc.decode(tf.io.read_file(filename), channels=channels, **head.imread_args)
+            return x_features, head(image), label
+
+        tfds = tfds.map(read, num_parallel_calls=num_parallel_reads).batch(batch_size)
+    else:
+        batch_transformations = shards.strip(transformations)
+
+        def read(x_features, rows, label):
+            images = tf.numpy_function(lambda rows: np.stack([shards.read(row) for row in rows]), [rows], tf.uint8)
+            images = tf.reshape(images, [-1, *shards.shape, 1])
+            if channels == 3:
+                # The shards are grayscale, repeated into rgb like the decoded jpeg files
+                images = tf.image.grayscale_to_rgb(images)
+            # Cropping in the tfimage backend returns float32
+            return x_features, tf.cast(images, tf.float32), label
+
+        tfds = tfds.batch(batch_size).map(read, num_parallel_calls=num_parallel_reads)
+
+    # Deterministic transformations run before the cache, random ones after it
+    num_deterministic = deterministic_length(batch_transformations)
+    prefix = imgproc.compile(batch_transformations[:num_deterministic])
+    suffix = imgproc.compile(batch_transformations[num_deterministic:])
+
+    def as_dtype(images):
+        if image_dtype == 'uint8' and images.dtype != tf.uint8:
+            return tf.cast(tf.clip_by_value(tf.round(images), 0, 255), tf.uint8)
+        return images
+
+    def prepare(x_features, images, label):
+        images = prefix.batch(images)
+        # Only the cached images are rounded here, the others stay float32 until the end
+        return x_features, as_dtype(images) if cache_dir is not None else images, label
+
+    tfds = tfds.map(prepare, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache_dir is not None:
+        cached = transformations[:len(transformations) - len(suffix.transformations)]
+        key = transformation_key(cached + [('decode', {'channels': channels, 'image_dtype': image_dtype})],
+                                 proc_module)
+        cache_path = os.path.join(cache_dir, 'tfdata', key)
+        os.makedirs(cache_path, exist_ok=True)
+        # The shuffled elements are cached apart from the ones in the order of the pipeline
+        if shuffle:
+            cache_key = f'{cache_key}-shuffled{seed}'
+        tfds = tfds.unbatch().cache(os.path.join(cache_path, cache_key))
+        if shuffle:
+            tfds = tfds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+        tfds = tfds.batch(batch_size)
+
+    def transform(x_features, images, label):
+        if len(suffix.transformations) > 0:
+            images = suffix.batch(tf.cast(images, tf.float32))
+        return (x_features, as_dtype(images)), label
+
+    tfds = tfds.map(transform, num_parallel_calls=tf.data.AUTOTUNE)
+    return tfds.repeat() if repeat else tfds
+
+
+def tf_cache_key(*columns):
+    """Hash the input columns of a tf.data pipeline, e.g. image paths and labels, into a short cache name.
+
+    Args:
+        columns: np.array columns, as given to tf.data.Dataset.from_tensor_slices.
+
+    Returns:
+        str: Hex digest identifying the columns.
+    """
+    digest = hashlib.sha1()
+    for column in columns:
+        column = np.asarray(column)
+        if column.dtype == object:
+            column = column.astype(str)
+        digest.update(str(column.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()[:16]
@@ -0,0 +1,92 @@
+import random
+import cv2
+import numpy as np
+from skimage.filters import median
+from skimage.util import img_as_float
+
+# import image processing library
+from src.data.imgproc_skimage import SKImageProcessing
+
+
+def _as_uint8(image):
+    # Equalisation in OpenCV works on 8 bit images, float images are in [0, 1]
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(image * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+class CV2ImageProcessing(SKImageProcessing):
+    """ Image processing with the SIMD optimised routines of OpenCV.
+
+        Images are numpy arrays like in SKImageProcessing, with the same value ranges and dtypes,
+        so crop, normalize, flatten and their fused forms are shared with it. The other
+        transformations match the skimage results within interpolation rounding.
+    """
+    # Batch forms of the skimage backend would not give the OpenCV results, run image by image instead
+    gaussian_blur_batch = None
+    median_blur_batch = None
+    adaptive_eqhist_batch = None
+
+    def imread(self, path, draft_size=None):
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise FileNotFoundError(f'No such image file: {path}')
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image
+
+    def imread_args(self, transformations):
+        return {}
+
+    def resize(self, image, size=(320, 320)):
+        image = img_as_float(image)
+        # Area interpolation anti-aliases when shrinking, like skimage.transform.resize
+        interpolation = cv2.INTER_AREA if size[0] < image.shape[0] else cv2.INTER_LINEAR
+        return cv2.resize(image, (size[1], size[0]), interpolation=interpolation)
+
+    def eqhist(self, image):
+        return cv2.equalizeHist(_as_uint8(image)) / 255.0
+
+    def adaptive_eqhist(self, image, kernel_size=None, clip_limit=0.03):
+        height, width = image.shape
+        if kernel_size is None:
+            kernel_size = (height // 8, width // 8)
+        # skimage clips at a fraction of the tile size, OpenCV at a multiple of the mean bin count
+        clahe = cv2.createCLAHE(clipLimit=clip_limit * 256,
+                                tileGridSize=(max(width // kernel_size[1], 1), max(height // kernel_size[0], 1)))
+        return clahe.apply(_as_uint8(image)) / 255.0
+
+    def gaussian_blur(self, image, sigma=3, truncate=3):
+        image = img_as_float(image)
+        radius = int(truncate * float(sigma) + 0.5)
+        return cv2.GaussianBlur(image, (2 * radius + 1, 2 * radius + 1), sigmaX=sigma, sigmaY=sigma,
+                                borderType=cv2.BORDER_REPLICATE)
+
+    def median_blur(self, image):
+        if image.dtype == np.float64:
+            # The float64 output of the other transformations is filtered in float32, medianBlur has no float64
+            return cv2.medianBlur(image.astype(np.float32), 3).astype(np.float64)
+        if image.dtype not in (np.uint8, np.float32):
+            # medianBlur only supports these dtypes for a 3x3 window
+            return median(image)
+        return cv2.medianBlur(image, 3)
+
+    def rotate(self, image, degree=None, rng=None):
+        if degree is None:
+            degree = (rng or random).randrange(-10, 10)
+        image = img_as_float(image)
+        height, width = image.shape
+        matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), degree, 1.0)
+        return cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def zoom(self, image, percentage=None, rng=None):
+        if percentage is None:
+            percentage = (rng or random).uniform(1.0, 1.25)
+        height, width = image.shape
+        enlarge = cv2.resize(img_as_float(image), (round(width*percentage), round(height*percentage)),
+                             interpolation=cv2.INTER_LINEAR)
+
+        top = (enlarge.shape[0]-height)//2
+        left = (enlarge.shape[1]-width)//2
+        return enlarge[top:top+height, left:left+width]
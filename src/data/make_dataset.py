@@ -1,19 +1,125 @@
 # -*- coding: utf-8 -*-
 import click
+import json
 import logging
+import os
+from multiprocessing import Pool
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
+import numpy as np
+import pandas as pd
+from skimage.io import imread
+
+# Splits of the CheXpert download packed into shards
+SPLITS = ['train', 'valid']
+
+
+def crop_or_pad(image, size=(320, 320)):
+    """Centre crop an image to size, zero padding the sides smaller than size.
+
+    Args:
+        image (np.array): 2-D image.
+        size (tuple, optional): Output height and width. Defaults to (320, 320).
+
+    Returns:
+        np.array: Image of shape size.
+    """
+    output = np.zeros(size, dtype=image.dtype)
+    src, dst = [], []
+    for length, target in zip(image.shape, size):
+        # Same offsets as the crop of SKImageProcessing when cropping
+        if length >= target:
+            offset = (length - target) // 2
+            src.append(slice(offset, offset + target))
+            dst.append(slice(0, target))
+        else:
+            offset = (target - length) // 2
+            src.append(slice(0, length))
+            dst.append(slice(offset, offset + length))
+    output[tuple(dst)] = image[tuple(src)]
+    return output
+
+
+def _pack_shard(shard_path, paths, size):
+    """Read, crop and save the images of one shard as a (n, height, width) uint8 .npy file."""
+    images = np.empty((len(paths), *size), dtype=np.uint8)
+    for row, path in enumerate(paths):
+        image = imread(path)
+        # CheXpert images are grayscale, keep the first channel of the few stored as RGB
+        if image.ndim == 3:
+            image = image[..., 0]
+        images[row] = crop_or_pad(image, size)
+    np.save(shard_path, images)
+    return len(paths)
+
+
+def pack_split(label_csv_path, image_path_base, output_dir, size=(320, 320), shard_size=1024, n_jobs=None):
+    """Pack the images of a label csv into cropped uint8 shards with a label sidecar and a manifest.
+
+    The sidecar is a copy of the label csv, its rows are in the order of the images in the shards.
+
+    Args:
+        label_csv_path (string): Path to label csv file.
+        image_path_base (string): Base path replacing 'CheXpert-v1.0-small' in the csv paths.
+        output_dir (string): Directory for the shards, the sidecar and the manifest.
+        size (tuple, optional): Crop size of the images. Defaults to (320, 320).
+        shard_size (int, optional): Number of images in one shard. Defaults to 1024.
+        n_jobs (int, optional): Number of processes reading the images. Defaults to None, one per core.
+
+    Returns:
+        dict: The manifest.
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(output_dir, exist_ok=True)
+    df = pd.read_csv(label_csv_path)
+    paths = df['Path'].str.replace('CheXpert-v1.0-small', image_path_base, regex=False).tolist()
+    size = tuple(size)
+
+    shards = [f'images-{i:05d}.npy' for i in range(0, (len(paths) + shard_size - 1) // shard_size)]
+    tasks = [(os.path.join(output_dir, shard), paths[i * shard_size:(i + 1) * shard_size], size)
+             for i, shard in enumerate(shards)]
+    with Pool(n_jobs) as pool:
+        for i, count in enumerate(pool.starmap(_pack_shard, tasks)):
+            logger.info(f'packed {count} images into {shards[i]}')
+
+    df.to_csv(os.path.join(output_dir, 'labels.csv'), index=False)
+    manifest = {
+        'num_images': len(paths),
+        'shape': list(size),
+        'dtype': 'uint8',
+        'shard_size': shard_size,
+        'shards': shards,
+        'labels': 'labels.csv',
+        # Transformations already applied to the packed images
+        'transformations': [['crop', {'size': list(size)}]]
+    }
+    # Written last, so a directory with a manifest always holds complete shards
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@click.option('--size', type=int, default=320, help='Crop size of the packed images.')
+@click.option('--shard_size', type=int, default=1024, help='Number of images in one shard.')
+@click.option('--n_jobs', type=int, default=None, help='Number of processes reading the images.')
+def main(input_filepath, output_filepath, size, shard_size, n_jobs):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
+
+        Every split csv of CheXpert-v1.0-small is packed into a directory of
+        uint8 image shards, read by ImageDataset through its shard_dir argument.
     """
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
+    for split in SPLITS:
+        label_csv_path = os.path.join(input_filepath, 'CheXpert-v1.0-small', f'{split}.csv')
+        output_dir = os.path.join(output_filepath, split)
+        manifest = pack_split(label_csv_path, input_filepath, output_dir, size=(size, size),
+                              shard_size=shard_size, n_jobs=n_jobs)
+        logger.info(f"packed {manifest['num_images']} {split} images into {output_dir}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+def _as_lists(transformations):
+    # yaml configs give lists, code defaults tuples
+    return json.loads(json.dumps([[trans, args] for trans, args in transformations]))
+
+
+class ShardStore():
+    """ Read-only access to the image shards packed by make_dataset.
+
+        The shards are memory-mapped on first access, so an image is read without opening its jpeg.
+        Images are looked up by their path after the same base path replacement as ImageDataset.
+
+        Args:
+            shard_dir (string): Directory with the manifest.json written by make_dataset.
+            image_path_base (string, optional): Base path for the image path in the label csv. Defaults to None.
+    """
+    def __init__(self, shard_dir, image_path_base=None):
+        with open(os.path.join(shard_dir, 'manifest.json'), 'r') as file:
+            manifest = json.load(file)
+        self.shard_dir = shard_dir
+        self.shape = tuple(manifest['shape'])
+        self.shard_size = manifest['shard_size']
+        self.transformations = manifest['transformations']
+        self.label_csv_path = os.path.join(shard_dir, manifest['labels'])
+        self._shard_files = [os.path.join(shard_dir, shard) for shard in manifest['shards']]
+        self._shards = [None] * len(self._shard_files)
+
+        paths = pd.read_csv(self.label_csv_path, usecols=['Path'])['Path']
+        if image_path_base is not None:
+            paths = paths.str.replace('CheXpert-v1.0-small', image_path_base, regex=False)
+        self.index = dict(zip(paths, range(len(paths))))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getstate__(self):
+        # Memory maps would be pickled as full copies, they are re-opened on demand instead
+        state = self.__dict__.copy()
+        state['_shards'] = [None] * len(self._shard_files)
+        return state
+
+    def strip(self, transformations):
+        """Remove the transformations applied when packing from the front of a transformation list.
+
+        Args:
+            transformations (list): list of image transformations and their arguments.
+
+        Returns:
+            list: The transformations left to apply to the packed images.
+        """
+        num_packed = len(self.transformations)
+        if _as_lists(transformations[:num_packed]) != self.transformations:
+            raise ValueError(f'Transformations {transformations} do not start with the packed {self.transformations}')
+        return transformations[num_packed:]
+
+    def read(self, row):
+        """Read a packed image by its row in the label sidecar.
+
+        Args:
+            row (int): Row of the image.
+
+        Returns:
+            np.array: uint8 image.
+        """
+        shard, row = divmod(int(row), self.shard_size)
+        if self._shards[shard] is None:
+            self._shards[shard] = np.load(self._shard_files[shard], mmap_mode='r')
+        return self._shards[shard][row]
+
+    def get(self, path):
+        """Read a packed image by its path.
+
+        Args:
+            path (string): Image path after the base path replacement.
+
+        Returns:
+            np.array: uint8 image.
+        """
+        return self.read(self.index[path])
+
+    def rows(self, paths):
+        """Rows of images in the shards, e.g. to read them in a tf.data pipeline.
+
+        Args:
+            paths (list): Image paths after the base path replacement.
+
+        Returns:
+            np.array: int64 rows.
+        """
+        return np.array([self.index[path] for path in paths], dtype=np.int64)
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import numpy as np
+import tensorflow as tf
+
+from src.data.cache import transformation_key
+from src.data.imgproc import tf_cache_key, tf_read_batches
+
+# Batches held in the shuffle buffer of the cached training images
+SHUFFLE_BATCHES = 16
+
+
+def tf_columns(dataset, return_labels):
+    """Input columns for tf.data: features, image path or row in the packed shards, and labels.
+    The columns are the arrays of the dataset, so the pipelines read the images in the order of its labels.
+
+    Args:
+        dataset (ImageDataset): Dataset to read the images from.
+        return_labels (list): Labels to predict, empty for no labels.
+
+    Returns:
+        tuple: np.array columns of features, images and labels.
+    """
+    # features brings the paths up to date with df as well
+    features = dataset.features()
+    images = dataset._paths if dataset.shards is None else dataset.shards.rows(dataset._paths)
+    return features, images, dataset.labels(return_labels).astype(np.float32)
+
+
+def model_channels(model):
+    """Channels of the images a keras model takes, 3 for the models built on rgb imagenet stems.
+
+    Args:
+        model (tf.keras.Model): Model with feature and image inputs.
+
+    Returns:
+        int: Number of channels of the image input.
+    """
+    return model.input[1].shape[-1]
+
+
+def _tune(tfds, deterministic=True):
+    # Autotuned parallel maps and prefetch, overlapping the reads with the model steps. Autotuning is on by
+    # default, and the experimental name of deterministic is the one tensorflow 2.5 knows
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    return tfds.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
+def _pipeline(dataset, columns, batch_size, transformations, channels=1, image_dtype='float32', cache_dir=None,
+              train=False, shuffle_buffer=None, num_parallel_reads=tf.data.AUTOTUNE):
+    if shuffle_buffer is None:
+        shuffle_buffer = SHUFFLE_BATCHES * batch_size
+    cache_key = tf_cache_key(*columns) if cache_dir is not None else None
+    return tf_read_batches(tf.data.Dataset.from_tensor_slices(columns), batch_size, shards=dataset.shards,
+                           channels=channels, proc_module='tfimage', image_dtype=image_dtype,
+                           cache_dir=cache_dir, cache_key=cache_key,
+                           shuffle=train, shuffle_buffer=shuffle_buffer, repeat=train,
+                           seed=dataset.random_state, num_parallel_reads=num_parallel_reads,
+                           transformations=transformations)
+
+
+def train_pipeline(dataset, batch_size, transformations, return_labels, channels=1, image_dtype='float32',
+                   cache_dir=None, shuffle_buffer=None, num_parallel_reads=tf.data.AUTOTUNE, deterministic=True):
+    """Training batches of an ImageDataset, reshuffled on every pass and repeated indefinitely, so one pipeline
+    serves all the epochs with model.fit taking steps_per_epoch batches from it.
+
+    Args:
+        dataset (ImageDataset): Dataset to read the images from, with its shards if packed.
+        batch_size (int): Batch size.
+        transformations (list): Image transformations and their arguments, starting with crop or resize.
+        return_labels (list): Labels to predict.
+        channels (int, optional): Channels of the images, see model_channels. Defaults to 1.
+        image_dtype (str, optional): 'float32' for normalized images, or 'uint8'. Defaults to 'float32'.
+        cache_dir (string, optional): Base directory for the tf.data cache. Defaults to None, no caching.
+        shuffle_buffer (int, optional): Cached images held in the shuffle buffer. Defaults to None,
+            SHUFFLE_BATCHES batches.
+        num_parallel_reads (int, optional): Images read in parallel. Defaults to tf.data.AUTOTUNE.
+        deterministic (bool, optional): False lets the parallel reads finish out of order, interleaving the
+            slow jpeg files with the others. Defaults to True.
+
+    Returns:
+        tf.data.Dataset: Prefetched batches of ((features, images), labels).
+    """
+    tfds = _pipeline(dataset, tf_columns(dataset, return_labels), batch_size, transformations, channels,
+                     image_dtype, cache_dir, train=True, shuffle_buffer=shuffle_buffer,
+                     num_parallel_reads=num_parallel_reads)
+    return _tune(tfds, deterministic)
+
+
+def eval_pipeline(dataset, batch_size, transformations, return_labels, channels=1, image_dtype='float32',
+                  cache_dir=None, num_parallel_reads=tf.data.AUTOTUNE):
+    """Evaluation batches of an ImageDataset, in the order of its table so that predictions line up with
+    dataset.labels.
+
+    Args:
+        dataset (ImageDataset): Dataset to read the images from, with its shards if packed.
+        batch_size (int): Batch size.
+        transformations (list): Image transformations and their arguments, starting with crop or resize.
+        return_labels (list): Labels to predict.
+        channels (int, optional): Channels of the images, see model_channels. Defaults to 1.
+        image_dtype (str, optional): 'float32' for normalized images, or 'uint8'. Defaults to 'float32'.
+        cache_dir (string, optional): Base directory for the tf.data cache. Defaults to None, no caching.
+        num_parallel_reads (int, optional): Images read in parallel. Defaults to tf.data.AUTOTUNE.
+
+    Returns:
+        tf.data.Dataset: Prefetched batches of ((features, images), labels).
+    """
+    tfds = _pipeline(dataset, tf_columns(dataset, return_labels), batch_size, transformations, channels,
+                     image_dtype, cache_dir, num_parallel_reads=num_parallel_reads)
+    return _tune(tfds)
+
+
+def inference_pipeline(dataset, batch_size, transformations, channels=1, image_dtype='float32',
+                       num_parallel_reads=tf.data.AUTOTUNE):
+    """Model inputs of an ImageDataset for prediction, without labels, in the order of its table.
+
+    Args:
+        dataset (ImageDataset): Dataset to read the images from, with its shards if packed.
+        batch_size (int): Batch size.
+        transformations (list): Image transformations and their arguments, starting with crop or resize.
+        channels (int, optional): Channels of the images, see model_channels. Defaults to 1.
+        image_dtype (str, optional): 'float32' for normalized images, or 'uint8'. Defaults to 'float32'.
+        num_parallel_reads (int, optional): Images read in parallel. Defaults to tf.data.AUTOTUNE.
+
+    Returns:
+        tf.data.Dataset: Prefetched batches of (features, images).
+    """
+    tfds = _pipeline(dataset, tf_columns(dataset, []), batch_size, transformations, channels, image_dtype,
+                     num_parallel_reads=num_parallel_reads)
+    return _tune(tfds.map(lambda inputs, label: inputs))
+
+
+def embed_images(embedding_model, dataset, batch_size, transformations, embedding_dir, image_dtype='float32'):
+    """Embeddings of the images of an ImageDataset by a frozen model, e.g. the pooled output of a cnn base from
+    split_head, in the order of its table. They are computed once into a .npy file under embedding_dir, keyed by
+    the model weights, the transformations and the images, and memory-mapped by every later call.
+
+    Args:
+        embedding_model (tf.keras.Model): Frozen model taking the images only.
+        dataset (ImageDataset): Dataset to read the images from, with its shards if packed.
+        batch_size (int): Batch size.
+        transformations (list): Deterministic image transformations and their arguments, starting with crop or resize.
+        embedding_dir (string): Directory of the embedding files.
+        image_dtype (str, optional): 'float32' for normalized images, or 'uint8'. Defaults to 'float32'.
+
+    Returns:
+        np.memmap: float32 embeddings, one row per image.
+    """
+    # The model name is left out, the same weights rebuilt under another name give the same embeddings
+    key = hashlib.sha1()
+    for weights in embedding_model.get_weights():
+        key.update(weights.tobytes())
+    key.update(transformation_key(transformations, 'tfimage').encode('utf-8'))
+    key.update(image_dtype.encode('utf-8'))
+    key.update(tf_cache_key(dataset._paths).encode('utf-8'))
+    path = os.path.join(embedding_dir, f'{key.hexdigest()[:16]}.npy')
+    if not os.path.exists(path):
+        os.makedirs(embedding_dir, exist_ok=True)
+        # Written to a temporary file first, so a partly written file is never read
+        tmp_path = f'{path}.tmp.npy'
+        shape = (len(dataset), *embedding_model.output_shape[1:])
+        embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+        start = 0
+        for _, images in inference_pipeline(dataset, batch_size, transformations,
+                                            channels=embedding_model.input_shape[-1], image_dtype=image_dtype):
+            batch = embedding_model.predict_on_batch(images)
+            embeddings[start:start + len(batch)] = batch
+            start += len(batch)
+        embeddings.flush()
+        del embeddings
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def embedding_pipeline(dataset, embeddings, batch_size, return_labels, train=False):
+    """Batches of a model head on the cached embeddings of the images of an ImageDataset, like train_pipeline
+    with train and eval_pipeline otherwise. Only the rows of a batch are read from the memory-mapped embeddings.
+
+    Args:
+        dataset (ImageDataset): Dataset the embeddings are of.
+        embeddings (np.array): Embeddings of the images in the order of the table of the dataset, from embed_images.
+        batch_size (int): Batch size.
+        return_labels (list): Labels to predict.
+        train (bool, optional): Reshuffle the rows on every pass and repeat the passes indefinitely. Defaults to False.
+
+    Returns:
+        tf.data.Dataset: Prefetched batches of ((features, embeddings), labels).
+    """
+    features = tf.constant(dataset.features())
+    labels = tf.constant(dataset.labels(return_labels).astype(np.float32))
+    tfds = tf.data.Dataset.range(len(dataset))
+    if train:
+        tfds = tfds.shuffle(len(dataset), seed=dataset.random_state, reshuffle_each_iteration=True)
+
+    def read(rows):
+        x_embeddings = tf.numpy_function(lambda rows: np.asarray(embeddings[rows], dtype=np.float32), [rows],
+                                         tf.float32)
+        x_embeddings = tf.reshape(x_embeddings, [-1, *embeddings.shape[1:]])
+        return (tf.gather(features, rows), x_embeddings), tf.gather(labels, rows)
+
+    tfds = tfds.batch(batch_size).map(read, num_parallel_calls=tf.data.AUTOTUNE)
+    return _tune(tfds.repeat() if train else tfds)
@@ -7,6 +7,89 @@ from keras.layers import Activation, Add, \
     Input, Lambda, MaxPooling2D, MaxPool2D, ZeroPadding2D, Concatenate
 from keras.initializers import glorot_uniform
 
+# <----- INPUT UTILITY FUNCTIONS ----->
+# preprocessing of the image input inside the model, so the input pipeline can feed uint8 images
+def preprocess_image(X):
+    #uint8 images are cast and scaled to [0, 1] like the normalize transformation
+    if X.dtype == tf.uint8:
+        X = tf.keras.layers.experimental.preprocessing.Rescaling(1.0 / 255)(X)
+
+    return X
+
+
+# copy the weights of an imagenet model into the same model built for grayscale images,
+# the kernel of the first convolution is summed over the rgb channels
+def fold_rgb_weights(cnn_base, gray_base):
+    folded = False
+    for layer, gray_layer in zip(cnn_base.layers, gray_base.layers):
+        weights = layer.get_weights()
+        if not folded and isinstance(layer, tf.keras.layers.Conv2D):
+            #a convolution is linear, so the folded kernel on a grayscale image
+            #gives the same output as the rgb kernel on three copies of it
+            weights[0] = weights[0].sum(axis=2, keepdims=True)
+            folded = True
+        gray_layer.set_weights(weights)
+
+
+# imagenet cnn base taking images with the channels of image_shape, without the top
+def imagenet_base(application, image_shape):
+    cnn_base = application(include_top=False, weights='imagenet')
+    if image_shape[-1] == 3:
+        return cnn_base
+
+    #single channel stem, a third of the first layer flops and input memory
+    gray_base = application(include_top=False, weights=None, input_shape=(None, None, image_shape[-1]))
+    fold_rgb_weights(cnn_base, gray_base)
+    return gray_base
+
+
+# find the cnn base of a model, the first nested model, or the model itself if built from scratch
+def backbone(model):
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            return layer
+    return model
+
+
+# dense head of the keras application models, on the pooled embedding of the cnn base and the non-image features,
+# built as a model of its own so that it can also be trained on cached embeddings
+def classification_head(output_size, feature_shape, embedding_size):
+    inputs_feature = tf.keras.Input(shape=feature_shape)
+    inputs_embedding = tf.keras.Input(shape=(embedding_size,))
+
+    #branch 2 for the non-image features
+    x2 = tf.keras.layers.Dense(10)(inputs_feature)
+    x2 = tf.keras.layers.Activation("relu")(x2)
+    x2 = tf.keras.layers.Dropout(0.5)(x2)
+
+    #concatenate the branches
+    x = tf.keras.layers.Concatenate()([inputs_embedding, x2])
+    x = tf.keras.layers.Activation('relu')(x)
+
+    # create output layer
+    x = tf.keras.layers.Dense(output_size)(x)
+    x = tf.keras.layers.Activation("sigmoid", name='predicted_observations')(x)
+
+    return tf.keras.Model(inputs=[inputs_feature, inputs_embedding], outputs=x, name='head')
+
+
+# split a model with a frozen cnn base into the model of its pooled image embedding and its head,
+# None if the cnn base is trainable or the model has no head model
+def split_head(model):
+    try:
+        head = model.get_layer('head')
+    except ValueError:
+        return None
+    cnn_base = backbone(model)
+    if cnn_base.trainable and any(layer.trainable for layer in cnn_base.layers):
+        return None
+
+    #the head layers are shared, training the head trains the model
+    embedding = head.get_input_at(0)[1]
+    embedding_model = tf.keras.Model(inputs=model.inputs[1], outputs=embedding, name=f'{model.name}_embedding')
+    return embedding_model, head
+
+
 # <----- RESNET UTILITY FUNCTIONS ----->
 # define function to create identity blocks
 def identity_block(X, f, filters, stage, block):
@@ -81,14 +164,15 @@ def convolutional_block(X, f, filters, stage, block, s=2):
 def ResNet152_new(output_size, 
                   not_transfer=False, 
                   feature_shape=(4,), 
-                  image_shape=(320,320, 1)):
+                  image_shape=(320,320, 1),
+                  image_dtype='float32'):
 
     inputs_feature = tf.keras.layers.Input(shape=feature_shape)
-    inputs_image = tf.keras.layers.Input(shape=image_shape)
+    inputs_image = tf.keras.layers.Input(shape=image_shape, dtype=image_dtype)
     
     # define branch 1
     # define resnet layers
-    x1 = tf.keras.layers.ZeroPadding2D((3, 3))(inputs_image)
+    x1 = tf.keras.layers.ZeroPadding2D((3, 3))(preprocess_image(inputs_image))
     
     #first conv layer
     x1 = tf.keras.layers.Conv2D(64, (7, 7), strides=(2, 2), name='conv1', kernel_initializer=glorot_uniform(seed=0))(x1)
@@ -188,10 +272,11 @@ def DenseNet121_new(output_size,
                     not_transfer=False, 
                     feature_shape=(3,), 
                     image_shape=(320,320, 1),
-                    filters = 32):
+                    filters = 32,
+                    image_dtype='float32'):
 
     inputs_feature = tf.keras.layers.Input(shape=feature_shape)
-    inputs_image = tf.keras.layers.Input(shape=image_shape)
+    inputs_image = tf.keras.layers.Input(shape=image_shape, dtype=image_dtype)
     
     #utility functions for densenet
     #batch norm + relu + conv
@@ -217,7 +302,7 @@ def DenseNet121_new(output_size,
         return x
 
     #build branch 1 for img data
-    x1 = tf.keras.layers.Conv2D(64, 7, strides = 2, padding = 'same')(inputs_image)
+    x1 = tf.keras.layers.Conv2D(64, 7, strides = 2, padding = 'same')(preprocess_image(inputs_image))
     x1 = tf.keras.layers.MaxPool2D(3, strides = 2, padding = 'same')(x1)
     
     for repetition in [6,12,24,16]:   
@@ -257,33 +342,24 @@ def DenseNet121_new(output_size,
 def MobileNetv2_keras(output_size, 
                       not_transfer=False, 
                       feature_shape=(4,), 
-                      image_shape=(320,320, 3)):
+                      image_shape=(320,320, 1),
+                      image_dtype='float32'):
 
-    cnn_base = tf.keras.applications.mobilenet_v2.MobileNetV2(include_top=False,
-                                                              weights='imagenet')
+    cnn_base = imagenet_base(tf.keras.applications.mobilenet_v2.MobileNetV2, image_shape)
     cnn_base.trainable = False
     print(cnn_base.summary())
     
     #inputs
     inputs_feature = tf.keras.Input(shape=feature_shape)
-    inputs_image = tf.keras.Input(shape=image_shape)
+    inputs_image = tf.keras.Input(shape=image_shape, dtype=image_dtype)
     
-    x1 = cnn_base(inputs_image, training=False)
+    x1 = cnn_base(preprocess_image(inputs_image), training=False)
     x1 = tf.keras.layers.GlobalAveragePooling2D()(x1)
     x1 = tf.keras.layers.Flatten()(x1)
     
-    #branch 2 for the non-image features
-    x2 = tf.keras.layers.Dense(10)(inputs_feature)
-    x2 = tf.keras.layers.Activation("relu")(x2)
-    x2 = tf.keras.layers.Dropout(0.5)(x2)
-    
-    #conatenate the features
-    x = tf.keras.layers.Concatenate()([x1, x2])
-    x = tf.keras.layers.Activation('relu')(x)
-
-    # create output layer
-    x = tf.keras.layers.Dense(output_size)(x)
-    x = tf.keras.layers.Activation("sigmoid", name='predicted_observations')(x)
+    #head on the image embedding and the non-image features
+    head = classification_head(output_size, feature_shape, cnn_base.output_shape[-1])
+    x = head([inputs_feature, x1])
 
     # create model class
     model = tf.keras.Model(inputs=[inputs_feature, inputs_image], 
@@ -296,10 +372,10 @@ def MobileNetv2_keras(output_size,
 def MobileNetv2_pop1(output_size, 
                       not_transfer=False, 
                       feature_shape=(4,), 
-                      image_shape=(320,320,3)):
+                      image_shape=(320,320,1),
+                      image_dtype='float32'):
 
-    cnn_base = tf.keras.applications.mobilenet_v2.MobileNetV2(include_top=False,
-                                                              weights='imagenet')
+    cnn_base = imagenet_base(tf.keras.applications.mobilenet_v2.MobileNetV2, image_shape)
     cnn_base.trainable = not_transfer
     
     pop_model = tf.keras.Model(inputs=cnn_base.inputs, outputs=cnn_base.get_layer('block_15_project_BN').output)
@@ -318,9 +394,9 @@ def MobileNetv2_pop1(output_size,
     
     #inputs
     inputs_feature = tf.keras.Input(shape=feature_shape)
-    inputs_image = tf.keras.Input(shape=image_shape)
+    inputs_image = tf.keras.Input(shape=image_shape, dtype=image_dtype)
     
-    x1 = pop_model(inputs_image, training=not_transfer)
+    x1 = pop_model(preprocess_image(inputs_image), training=not_transfer)
     x1 = tf.keras.layers.Conv2D.from_config(conv_1_config)(x1)
     x1 = tf.keras.layers.BatchNormalization.from_config(conv_1_bn_config)(x1)
     x1 = tf.keras.layers.ReLU.from_config(out_relu_config)(x1)
@@ -351,9 +427,9 @@ def MobileNetv2_pop1(output_size,
 def MobileNetv2_pop2(output_size, 
                       not_transfer=False, 
                       feature_shape=(4,), 
-                      image_shape=(320,320,3)):
-    cnn_base = tf.keras.applications.mobilenet_v2.MobileNetV2(include_top=False,
-                                                              weights='imagenet')
+                      image_shape=(320,320,1),
+                      image_dtype='float32'):
+    cnn_base = imagenet_base(tf.keras.applications.mobilenet_v2.MobileNetV2, image_shape)
     cnn_base.trainable = not_transfer
     
     pop_model = tf.keras.Model(inputs=cnn_base.inputs, outputs=cnn_base.get_layer('block_14_project_BN').output)
@@ -372,9 +448,9 @@ def MobileNetv2_pop2(output_size,
     
     #inputs
     inputs_feature = tf.keras.Input(shape=feature_shape)
-    inputs_image = tf.keras.Input(shape=image_shape)
+    inputs_image = tf.keras.Input(shape=image_shape, dtype=image_dtype)
     
-    x1 = pop_model(inputs_image, training=not_transfer)
+    x1 = pop_model(preprocess_image(inputs_image), training=not_transfer)
     x1 = tf.keras.layers.Conv2D.from_config(conv_1_config)(x1)
     x1 = tf.keras.layers.BatchNormalization.from_config(conv_1_bn_config)(x1)
     x1 = tf.keras.layers.ReLU.from_config(out_relu_config)(x1)
@@ -405,33 +481,24 @@ def MobileNetv2_pop2(output_size,
 def DenseNet121_keras(output_size, 
                       not_transfer=False, 
                       feature_shape=(4,), 
-                      image_shape=(320,320, 3)):
+                      image_shape=(320,320, 1),
+                      image_dtype='float32'):
 
-    cnn_base = tf.keras.applications.DenseNet121(include_top=False,
-                                                 weights='imagenet')
+    cnn_base = imagenet_base(tf.keras.applications.DenseNet121, image_shape)
     cnn_base.trainable = False
 
     #create 2 input layers, one for img and one for non-img
     inputs_feature = tf.keras.Input(shape=feature_shape)
-    inputs_image = tf.keras.Input(shape=image_shape)
+    inputs_image = tf.keras.Input(shape=image_shape, dtype=image_dtype)
     
     #use densenet for the img
-    x1 = cnn_base(inputs_image, training=False)
+    x1 = cnn_base(preprocess_image(inputs_image), training=False)
     x1 = tf.keras.layers.GlobalAveragePooling2D()(x1)
     x1 = tf.keras.layers.Flatten()(x1)
     
-    #branch 2 for the non-image features
-    x2 = tf.keras.layers.Dense(10)(inputs_feature)
-    x2 = tf.keras.layers.Activation("relu")(x2)
-    x2 = tf.keras.layers.Dropout(0.5)(x2)
-    
-    #conatenate the features
-    x = tf.keras.layers.Concatenate()([x1, x2])
-    x = tf.keras.layers.Activation('relu')(x)
-
-    # create output layer
-    x = tf.keras.layers.Dense(output_size)(x)
-    x = tf.keras.layers.Activation("sigmoid", name='predicted_observations')(x)
+    #head on the image embedding and the non-image features
+    head = classification_head(output_size, feature_shape, cnn_base.output_shape[-1])
+    x = head([inputs_feature, x1])
 
     # create model class
     model = tf.keras.Model(inputs=[inputs_feature, inputs_image], 
@@ -444,33 +511,24 @@ def DenseNet121_keras(output_size,
 def ResNet152_keras(output_size, 
                     not_transfer=False, 
                     feature_shape=(4,), 
-                    image_shape=(320,320, 3)):
+                    image_shape=(320,320, 1),
+                    image_dtype='float32'):
 
-    cnn_base = tf.keras.applications.ResNet152(include_top=False,
-                                                 weights='imagenet')
+    cnn_base = imagenet_base(tf.keras.applications.ResNet152, image_shape)
     cnn_base.trainable = not_transfer
 
     #create 2 input layers, one for img and one for non-img
     inputs_feature = tf.keras.Input(shape=feature_shape)
-    inputs_image = tf.keras.Input(shape=image_shape)
+    inputs_image = tf.keras.Input(shape=image_shape, dtype=image_dtype)
     
     #use densenet for the img
-    x1 = cnn_base(inputs_image, training=False)
+    x1 = cnn_base(preprocess_image(inputs_image), training=False)
     x1 = tf.keras.layers.GlobalAveragePooling2D()(x1)
     x1 = tf.keras.layers.Flatten()(x1)
     
-    #branch 2 for the non-image features
-    x2 = tf.keras.layers.Dense(10)(inputs_feature)
-    x2 = tf.keras.layers.Activation("relu")(x2)
-    x2 = tf.keras.layers.Dropout(0.5)(x2)
-    
-    #concatenate the branches
-    x = tf.keras.layers.Concatenate()([x1, x2])
-    x = tf.keras.layers.Activation('relu')(x)
-
-    # create output layer
-    x = tf.keras.layers.Dense(output_size)(x)
-    x = tf.keras.layers.Activation("sigmoid", name='predicted_observations')(x)
+    #head on the image embedding and the non-image features
+    head = classification_head(output_size, feature_shape, cnn_base.output_shape[-1])
+    x = head([inputs_feature, x1])
 
     # create model class
     model = tf.keras.Model(inputs=[inputs_feature, inputs_image], 
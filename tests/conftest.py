@@ -0,0 +1,29 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+LABELS = ['No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Opacity', 'Lung Lesion', 'Edema',
+          'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Pleural Effusion', 'Pleural Other',
+          'Fracture', 'Support Devices']
+
+
+@pytest.fixture
+def label_csv(tmp_path):
+    """Small CheXpert style label csv whose images are copies of the sample image."""
+    sample = os.path.join(os.path.dirname(__file__), 'view1_frontal.jpg')
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(10):
+        shutil.copy(sample, tmp_path / f'view{i}_frontal.jpg')
+        labels = rng.choice([np.nan, -1.0, 0.0, 1.0], size=len(LABELS)).tolist()
+        rows.append([f'CheXpert-v1.0-small/view{i}_frontal.jpg',
+                     ['Male', 'Female', 'Unknown'][i % 3],
+                     20 + i,
+                     'Frontal' if i % 4 else 'Lateral',
+                     ['AP', 'PA', np.nan][i % 3]] + labels)
+    df = pd.DataFrame(rows, columns=['Path', 'Sex', 'Age', 'Frontal/Lateral', 'AP/PA'] + LABELS)
+    csv_path = tmp_path / 'train.csv'
+    df.to_csv(csv_path, index=False)
+    return str(csv_path), str(tmp_path)
@@ -0,0 +1,140 @@
+import gc
+import pytest
+import numpy as np
+import pandas as pd
+from src.data.batchloader import BatchLoader, concat_features
+from src.data.dataset import ImageDataset
+
+transformations = [
+    ['crop', {'size': [320, 320]}],
+    ['normalize', {}],
+    ['flatten', {}]
+]
+
+
+def test_batchloader_workers(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    serial = list(dataset.batchloader(4))
+    parallel = list(dataset.batchloader(4, num_workers=3))
+    assert len(serial) == len(parallel) == 3
+    for (f1, x1, y1), (f2, x2, y2) in zip(serial, parallel):
+        np.testing.assert_array_equal(f1.values, f2.values)
+        np.testing.assert_array_equal(x1.values, x2.values)
+        np.testing.assert_array_equal(y1.values, y2.values)
+
+
+def test_load_workers_in_parts(label_csv, monkeypatch):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    # The 10 images are loaded through a shared buffer of 4 images
+    monkeypatch.setattr(BatchLoader, 'shared_rows_per_worker', 2)
+    _, serial, _ = dataset.load(return_numpy=True)
+    # No image is read in the parent process, even for the image shape
+    monkeypatch.setattr(ImageDataset, 'read_image', None)
+    read_first = BatchLoader._read_first
+    first_sizes = []
+
+    def read_first_image(self, rows):
+        images = read_first(self, rows)
+        first_sizes.append(len(images))
+        return images
+
+    # Only the first image is sent back to take the shape from
+    monkeypatch.setattr(BatchLoader, '_read_first', read_first_image)
+    _, parallel, _ = dataset.load(num_workers=2, return_numpy=True)
+    assert first_sizes == [1]
+    np.testing.assert_array_equal(parallel, serial)
+
+
+def test_load_serial_in_parts(label_csv, monkeypatch):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    _, expected, _ = dataset.load(return_numpy=True)
+    # The first image gives the shape, the others are read 3 at a time into the output
+    monkeypatch.setattr(BatchLoader, 'serial_rows', 3)
+    read_images = ImageDataset.read_images
+    sizes = []
+
+    def read_part(self, paths, out=None, epoch=0):
+        sizes.append(len(paths))
+        return read_images(self, paths, out=out, epoch=epoch)
+
+    monkeypatch.setattr(ImageDataset, 'read_images', read_part)
+    _, x_image, _ = dataset.load(return_numpy=True)
+    assert sizes == [1, 3, 3, 3]
+    np.testing.assert_array_equal(x_image, expected)
+
+
+def test_batchloader_prefetch(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    serial = list(dataset.batchloader(3))
+    prefetched = list(dataset.batchloader(3, prefetch=2))
+    assert len(prefetched) == len(serial) == 4
+    for (_, x1, _), (_, x2, _) in zip(serial, prefetched):
+        np.testing.assert_array_equal(x1.values, x2.values)
+
+
+def test_batchloader_prefetch_abandoned(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    loader = iter(dataset.batchloader(3, prefetch=1))
+    next(loader)
+    thread = loader._thread
+    # The consumer stops early and drops the loader, which stops the background thread
+    del loader
+    gc.collect()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+
+
+def test_batchloader_prefetch_raises_errors(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    dataset.df.loc[5, 'Path'] = image_path + '/missing.jpg'
+    loader = iter(dataset.batchloader(3, prefetch=2))
+    next(loader)
+    with pytest.raises(FileNotFoundError):
+        next(loader)
+
+
+def test_batchloader_return_numpy(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    return_labels = ['Edema', 'Atelectasis']
+    for num_workers in [0, 2]:
+        batches = zip(dataset.batchloader(4, return_labels),
+                      dataset.batchloader(4, return_labels, num_workers=num_workers, return_numpy=True))
+        for (f1, x1, y1), (f2, x2, y2) in batches:
+            assert x2.dtype == np.float32
+            assert x2.shape == (len(f1), 320 * 320)
+            X = concat_features(f2, x2)
+            assert X.shape == (len(f1), 4 + 320 * 320)
+            assert np.shares_memory(X, x2)
+            np.testing.assert_allclose(f2, f1.values.astype(np.float32))
+            np.testing.assert_array_equal(x2, x1.values)
+            np.testing.assert_array_equal(y2, y1.values)
+
+
+def test_batchloader_shuffle_and_shard(label_csv):
+    csv_path, image_path = label_csv
+    df = pd.read_csv(csv_path)
+    df['Age'] = np.arange(len(df))
+    dataset = ImageDataset(label_df=df, image_path_base=image_path, transformations=transformations)
+    ages = lambda loader: (np.concatenate([f[:, 1] for f, _, _ in loader]) * 100).round().astype(int).tolist()
+    loader = dataset.batchloader(3, return_numpy=True, shuffle=True, seed=7)
+    first, second = ages(loader), ages(loader)
+    assert sorted(first) == sorted(second) == list(range(10))
+    assert first != second
+    assert ages(dataset.batchloader(3, return_numpy=True, shuffle=True, seed=7)) == first
+    # A new loader continues from the epoch it is given
+    assert ages(dataset.batchloader(3, return_numpy=True, shuffle=True, seed=7, epoch=1)) == second
+
+    shards = [ages(dataset.batchloader(2, return_numpy=True, shuffle=True, seed=7, shard=(i, 3))) for i in range(3)]
+    assert [len(shard) for shard in shards] == [4, 3, 3]
+    assert sorted(sum(shards, [])) == sorted(first)
+
+    features, _, labels = next(iter(dataset.batchloader(2, return_numpy=True, shard=(1, 3))))
+    np.testing.assert_allclose(features[:, 1], [0.01, 0.04])
+    np.testing.assert_array_equal(labels, dataset._labels[[1, 4]])
@@ -0,0 +1,85 @@
+import numpy as np
+from src.data.cache import ImageCache
+from src.data.dataset import ImageDataset
+
+transformations = [
+    ['crop', {'size': [320, 320]}],
+    ['normalize', {}],
+    ['flatten', {}]
+]
+
+
+def test_image_cache(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    cache_dir = str(tmp_path / 'cache')
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=transformations, cache_dir=cache_dir)
+    x_features, x_image, y = dataset.load()
+    assert len(dataset.cache) == len(dataset)
+
+    cached = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                          transformations=transformations, cache_dir=cache_dir)
+    path = cached.df['Path'].iloc[0]
+    assert path in cached.cache
+    _, image, _ = cached[0]
+    assert image.dtype == np.float32
+    np.testing.assert_allclose(image, x_image.values[0], atol=1e-3)
+
+
+def test_image_cache_deterministic_prefix(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    augment = transformations[:2] + [['rotate', {}], ['zoom', {}], ['flatten', {}]]
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=augment, cache_dir=str(tmp_path / 'cache'))
+    # Only crop and normalize are cached
+    assert dataset.cache is not None
+    paths = dataset._paths[:4]
+    first = dataset.read_images(paths, epoch=0)
+    assert len(dataset.cache) == 4
+    assert dataset.cache.get(paths[0]).shape == (320, 320)
+
+    # Seeded per image and epoch, whatever the batch the image is read in
+    np.testing.assert_array_equal(dataset.read_images(paths[::-1], epoch=0), first[::-1])
+    np.testing.assert_array_equal(dataset.read_image(paths[1], epoch=0), first[1])
+    assert not np.array_equal(dataset.read_image(paths[1], epoch=1), first[1])
+    serial = np.concatenate([x.values for _, x, _ in dataset.batchloader(3)])
+    parallel = np.concatenate([x.values for _, x, _ in dataset.batchloader(3, num_workers=2)])
+    np.testing.assert_array_equal(serial, parallel)
+
+    random_first = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                                transformations=[['rotate', {}]] + transformations,
+                                cache_dir=str(tmp_path / 'cache'))
+    assert random_first.cache is None
+
+
+def test_image_cache_parallel_cold(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    augment = transformations[:2] + [['rotate', {}], ['zoom', {}], ['flatten', {}]]
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=augment, cache_dir=str(tmp_path / 'cache'))
+    # The workers read the images on a cold cache, after the random transformations
+    parallel = np.concatenate([x.values for _, x, _ in dataset.batchloader(3, num_workers=2)])
+    assert dataset.cache.shape in [None, (320, 320)]
+
+    reopened = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                            transformations=augment, cache_dir=str(tmp_path / 'cache'))
+    serial = np.concatenate([x.values for _, x, _ in reopened.batchloader(3)])
+    np.testing.assert_array_equal(serial, parallel)
+
+
+def test_image_cache_without_flush(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    cache = ImageCache(cache_dir, transformations)
+    images = np.random.default_rng(0).random((3, 4, 4), dtype=np.float32)
+    for i, image in enumerate(images):
+        cache.put(f'image{i}.jpg', image)
+    # As after a crash, nothing flushed and the last index entry cut short
+    with open(cache._index_file, 'a') as file:
+        file.write('3\timage')
+
+    reopened = ImageCache(cache_dir, transformations)
+    assert len(reopened) == 3
+    for i, image in enumerate(images):
+        np.testing.assert_allclose(reopened.get(f'image{i}.jpg'), image, atol=1e-3)
+    reopened.put('image3.jpg', images[0])
+    assert ImageCache(cache_dir, transformations).index['image3.jpg'] == 3
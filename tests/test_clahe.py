@@ -0,0 +1,33 @@
+import numpy as np
+import tensorflow as tf
+from skimage import exposure
+from src.data import imgproc
+from src.data.clahe import clahe, tf_clahe
+
+
+def test_clahe():
+    proc_class = imgproc.get_proc_class('skimage')
+    image = proc_class.imread("./tests/view1_frontal.jpg")
+    result = clahe(image)
+    assert result.shape == image.shape and result.dtype == np.float32
+    assert np.abs(result - exposure.equalize_adapthist(image, clip_limit=0.03)).mean() < 0.01
+    # Float images in [0, 1] give the same result
+    np.testing.assert_array_equal(clahe(image / 255.0), result)
+
+    # Every image of a batch is equalised on its own, tiles not dividing the image are padded
+    images = np.stack([image, 255 - image])
+    result = clahe(images, kernel_size=(48, 60))
+    for i in range(len(images)):
+        np.testing.assert_array_equal(result[i], clahe(images[i], kernel_size=(48, 60)))
+
+
+def test_tf_clahe():
+    proc_class = imgproc.get_proc_class('skimage')
+    image = proc_class.imread("./tests/view1_frontal.jpg")
+    images = np.stack([image, 255 - image])
+    for kernel_size in [None, (48, 60)]:
+        expected = clahe(images, kernel_size=kernel_size) * 255
+        result = tf.function(tf_clahe)(tf.constant(images[..., np.newaxis]), kernel_size=kernel_size)
+        np.testing.assert_allclose(result.numpy()[..., 0], expected, atol=1e-3)
+        result = tf_clahe(tf.constant(images[0, ..., np.newaxis], dtype=tf.float32), kernel_size=kernel_size)
+        np.testing.assert_allclose(result.numpy()[..., 0], expected[0], atol=1e-3)
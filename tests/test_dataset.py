@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.data.dataset import ImageDataset
+
+transformations = [
+    ['crop', {'size': [320, 320]}],
+    ['flatten', {}]
+]
+
+
+def test_columns_match_df(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=transformations, map_option='U-one')
+    valid_dataset = dataset.split(validsize=0.2)
+    for ds in [dataset, valid_dataset]:
+        features, image, labels = ds[1]
+        assert features.dtype == np.float32
+        assert labels.dtype == np.int8
+        np.testing.assert_allclose(features, ds.df[ds._feature_header].iloc[1].values.astype(np.float32))
+        np.testing.assert_array_equal(labels, ds.df[ds._label_header].iloc[1].values)
+        assert ds._paths[1] == ds.df['Path'].iloc[1]
+        assert image.shape == (320 * 320,)
+
+
+def test_load_dtype(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    x_features, x_image, y = dataset.load(['Edema'], return_numpy=True, dtype='uint8')
+    assert x_image.dtype == np.uint8
+    assert x_features.dtype == np.float32
+    assert y.shape == (len(dataset),)
+    x_features16, x_image16, _ = dataset.load(return_numpy=True, dtype='float16')
+    assert x_image16.dtype == np.float16
+    np.testing.assert_array_equal(x_image16, x_image)
+    np.testing.assert_allclose(x_features16, x_features, rtol=1e-3)
+    x_features_df, x_image_df, y_df = dataset.load()
+    np.testing.assert_array_equal(x_image_df.values, x_image)
+    assert list(y_df.columns) == list(dataset._label_header)
+
+
+def test_labels_match_load(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=transformations, map_option='U-one')
+    valid_dataset = dataset.split(validsize=0.2)
+    return_labels = list(dataset._label_header[[3, 1]])
+    for ds in [dataset, valid_dataset]:
+        x_features, _, y = ds.load(return_labels, return_numpy=True)
+        np.testing.assert_array_equal(ds.labels(return_labels), y)
+        np.testing.assert_array_equal(ds.features(), x_features)
+        assert ds.labels().shape == (len(ds), len(ds._label_header))
+    with pytest.raises(KeyError):
+        dataset.labels(['Unknown'])
+
+
+def test_label_snapshot(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    cache_dir = str(tmp_path / 'cache')
+    kwargs = dict(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations,
+                  frontal_only=True, map_option='U-zero', cache_dir=cache_dir)
+    dataset = ImageDataset(**kwargs)
+    assert len(list((tmp_path / 'cache' / 'labels').iterdir())) == 1
+    assert dataset.df['Sex'].dtype == np.int8
+    assert dataset.df[dataset._label_header].dtypes.eq(np.int8).all()
+
+    cached = ImageDataset(**kwargs)
+    pd.testing.assert_frame_equal(cached.df, dataset.df)
+    np.testing.assert_array_equal(cached._labels, dataset._labels)
+
+    ImageDataset(**dict(kwargs, frontal_only=False))
+    assert len(list((tmp_path / 'cache' / 'labels').iterdir())) == 2
+
+
+def test_uncertain_views(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    uncertain = dataset._labels == -1
+    assert uncertain.any()
+    views = dataset.uncertain_views()
+    for option, view in views.items():
+        mapped = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                              transformations=transformations, map_option=option)
+        np.testing.assert_array_equal(view._labels, mapped._labels)
+        assert set(np.unique(view._labels)) <= {0, 1}
+        np.testing.assert_array_equal(view._labels[~uncertain], dataset._labels[~uncertain])
+    assert (views['U-zero']._labels[uncertain] == 0).all()
+    assert (views['U-one']._labels[uncertain] == 1).all()
+
+
+def test_uncertain_views_after_split(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path,
+                           transformations=transformations, map_option='U-zero')
+    unmapped = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    unmapped_labels = dict(zip(unmapped._paths, unmapped._labels))
+    valid_dataset = dataset.split(validsize=0.2)
+    for ds in [dataset, valid_dataset]:
+        labels = np.stack([unmapped_labels[path] for path in ds._paths])
+        views = ds.uncertain_views(['U-zero', 'U-one'])
+        np.testing.assert_array_equal(views['U-zero']._labels, np.where(labels == -1, 0, labels))
+        np.testing.assert_array_equal(views['U-one']._labels, np.where(labels == -1, 1, labels))
+    assert (np.stack(list(unmapped_labels.values())) == -1).any()
+def test_read_images(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    blur = [['crop', {'size': [320, 320]}], ['median_blur', {}], ['normalize', {}], ['flatten', {}]]
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=blur,
+                           cache_dir=str(tmp_path / 'cache'))
+    expected = np.stack([dataset.imgproc.transform(dataset.imgproc.imread(path), blur) for path in dataset._paths])
+    first = dataset.read_images(dataset._paths[:4])
+    np.testing.assert_allclose(first, expected[:4], atol=1e-3)
+    # Cached and newly read images mixed in one batch, rounded the same way
+    images = dataset.read_images(dataset._paths)
+    np.testing.assert_array_equal(images[:4], first)
+    np.testing.assert_allclose(images, expected, atol=1e-3)
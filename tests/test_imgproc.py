@@ -1,4 +1,19 @@
+import os
+import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
+from skimage.filters import gaussian
 from src.data import imgproc
+from src.data.dataset import ImageDataset
+from src.data.imgproc import tf_cache_key, tf_read_batches, tf_read_image
+from src.data.make_dataset import pack_split
+
+transformations = [
+    ['crop', {'size': [320, 320]}],
+    ['normalize', {}],
+    ['flatten', {}]
+]
 
 def test_transform():
     path = "./tests/view1_frontal.jpg"
@@ -10,3 +25,195 @@ def test_transform():
     ]
     result = proc_class.transform(image, transformations)
     print(result)
+
+
+def test_read_draft_decode(tmp_path):
+    # Full resolution CheXpert images are about four times the size of the sample
+    path = str(tmp_path / 'large.jpg')
+    Image.open("./tests/view1_frontal.jpg").resize((1556, 1280), Image.BICUBIC).save(path, quality=95)
+    proc_class = imgproc.get_proc_class('skimage')
+    assert proc_class.imread(path, draft_size=(320, 320)).shape == (320, 389)
+    for size in [(320, 320), (224, 224)]:
+        transformations = [('resize', {'size': size})]
+        expected = proc_class.transform(proc_class.imread(path), transformations)
+        result = proc_class.read(path, transformations)
+        assert result.shape == expected.shape == size
+        assert np.abs(result - expected).mean() < 0.01
+
+    # Cropping keeps the full resolution decode
+    transformations = [('crop', {'size': (320, 320)})]
+    np.testing.assert_array_equal(proc_class.read(path, transformations),
+                                  proc_class.transform(proc_class.imread(path), transformations))
+
+
+def test_transform_batch():
+    proc_class = imgproc.get_proc_class('skimage')
+    image = proc_class.imread("./tests/view1_frontal.jpg")
+    rng = np.random.default_rng(0)
+    images = np.stack([image, 255 - image, rng.integers(0, 256, image.shape, dtype=np.uint8)])
+    for transformations in [
+        [('crop', {'size': (320, 320)}), ('normalize', {}), ('flatten', {})],
+        [('crop', {'size': (300, 280)}), ('gaussian_blur', {}), ('normalize', {})],
+        [('crop', {'size': (320, 320)}), ('median_blur', {}), ('normalize', {}), ('gaussian_blur', {'sigma': 1})],
+        [('crop', {'size': (320, 320)}), ('eqhist', {}), ('rotate', {'degree': 5}), ('zoom', {'percentage': 1.1})],
+        [('crop', {'size': (300, 280)}), ('adaptive_eqhist', {}), ('flatten', {})]
+    ]:
+        expected = np.stack([proc_class.transform(image, transformations) for image in images])
+        result = proc_class.transform_batch(images, transformations)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_pipeline():
+    proc_class = imgproc.get_proc_class('skimage')
+    image = proc_class.imread("./tests/view1_frontal.jpg")
+    images = np.stack([image, 255 - image])
+    for transformations in [
+        [('crop', {'size': (320, 320)}), ('normalize', {}), ('flatten', {})],
+        [('crop', {'size': (320, 320)}), ('normalize', {}), ('gaussian_blur', {'sigma': 2})],
+        [('crop', {'size': (320, 320)}), ('median_blur', {}), ('normalize', {}), ('flatten', {})]
+    ]:
+        pipeline = proc_class.compile(transformations)
+        expected = proc_class.transform(image, transformations)
+        np.testing.assert_array_equal(pipeline(image), expected)
+        out = np.empty(expected.size, dtype=np.float32)
+        assert pipeline(image, out=out) is out
+        np.testing.assert_array_equal(out, expected.ravel())
+        np.testing.assert_array_equal(pipeline.batch(images), proc_class.transform_batch(images, transformations))
+    assert len(proc_class.compile([('crop', {'size': (320, 320)}), ('normalize', {}), ('flatten', {})]).steps) == 1
+
+    # Precomputed kernels give the same values as skimage
+    np.testing.assert_array_equal(proc_class.gaussian_blur(image, sigma=3, truncate=3),
+                                  gaussian(image, sigma=3, truncate=3))
+
+    with pytest.raises(ValueError, match='Unknown transformation'):
+        proc_class.compile([('sharpen', {})])
+    with pytest.raises(ValueError, match='Invalid arguments'):
+        proc_class.compile([('crop', {'sise': (320, 320)})])
+
+
+def test_tf_crop_decode(tmp_path):
+    path = str(tmp_path / 'large.jpg')
+    Image.open("./tests/view1_frontal.jpg").resize((1556, 1280), Image.BICUBIC).save(path, quality=95)
+    proc_class = imgproc.get_proc_class('tfimage')
+    transformations = [('crop', {'size': (320, 320)}), ('normalize', {})]
+    assert proc_class.imread_args(transformations) == {'crop_size': (320, 320)}
+    for image_path in ["./tests/view1_frontal.jpg", path]:
+        image_string = tf.io.read_file(image_path)
+        # Windows larger than the image along one or both sides are padded like a full decode
+        for size in [(320, 320), (400, 400), (2000, 300)]:
+            expected = proc_class.crop(proc_class.decode(image_string), size)
+            result = proc_class.crop(proc_class.decode(image_string, crop_size=size), size)
+            np.testing.assert_array_equal(result.numpy(), expected.numpy())
+
+
+def test_tf_read_batches(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    shard_dir = str(tmp_path / 'processed' / 'train')
+    pack_split(csv_path, image_path, shard_dir, shard_size=4, n_jobs=1)
+    dataset = ImageDataset(image_path_base=image_path, transformations=transformations[:2], shard_dir=shard_dir)
+    features = dataset.df[dataset._feature_header].values.astype(np.float32)
+    labels = np.zeros((len(dataset.df), 2), dtype=np.float32)
+    paths = dataset.df['Path'].values
+    tail = [('gaussian_blur', {'sigma': 1}), ('adaptive_eqhist', {}), ('normalize', {}), ('zoom', {'percentage': 0.9})]
+    for channels in [1, 3]:
+        tfds = tf.data.Dataset.from_tensor_slices((features, paths, labels))
+        batches = list(tf_read_batches(tfds, 4, channels=channels, transformations=[transformations[0]] + tail))
+        assert [len(label) for _, label in batches] == [4, 4, 2]
+        (batch_features, images), _ = batches[0]
+        np.testing.assert_array_equal(batch_features.numpy(), features[:4])
+        assert images.shape == (4, 320, 320, channels)
+        for i in range(4):
+            (_, expected), _ = tf_read_image(features[i], paths[i], labels[i], channels=channels,
+                                             transformations=[transformations[0]] + tail)
+            # crop_and_resize samples the zoomed images slightly differently from central_crop and resize
+            np.testing.assert_allclose(images[i].numpy(), expected.numpy(), atol=0.05)
+
+    tfds = tf.data.Dataset.from_tensor_slices((features, dataset.shards.rows(paths), labels))
+    batches = tf_read_batches(tfds, 4, shards=dataset.shards, transformations=transformations[:2])
+    (_, images), _ = next(iter(batches))
+    assert images.shape == (4, 320, 320, 1)
+    for i in range(4):
+        np.testing.assert_allclose(images[i].numpy()[..., 0], dataset.read_image(paths[i]))
+    # Grayscale shards are repeated into the channels of rgb models
+    (_, rgb), _ = next(iter(tf_read_batches(tfds, 4, shards=dataset.shards, channels=3,
+                                            transformations=transformations[:2])))
+    assert rgb.shape == (4, 320, 320, 3)
+    np.testing.assert_array_equal(rgb.numpy(), np.repeat(images.numpy(), 3, axis=-1))
+
+    # uint8 images stay unnormalized
+    for shards, columns in [(None, paths), (dataset.shards, dataset.shards.rows(paths))]:
+        tfds = tf.data.Dataset.from_tensor_slices((features, columns, labels))
+        (_, images), _ = next(iter(tf_read_batches(tfds, 4, shards=shards, image_dtype='uint8',
+                                                   transformations=[transformations[0]] + tail)))
+        (_, expected), _ = next(iter(tf_read_batches(tfds, 4, shards=shards,
+                                                     transformations=[transformations[0]] + tail)))
+        assert images.dtype == tf.uint8 and images.shape == (4, 320, 320, 1)
+        np.testing.assert_allclose(images.numpy() / 255, expected.numpy(), atol=0.5 / 255 + 1e-6)
+
+
+def test_tf_read_batches_cache(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations[:2])
+    features = dataset.df[dataset._feature_header].values.astype(np.float32)
+    # The labels number the images, to follow their order through the cache
+    labels = np.repeat(np.arange(len(dataset.df), dtype=np.float32)[:, np.newaxis], 2, axis=1)
+    paths = dataset.df['Path'].values
+    cache_dir = str(tmp_path / 'cache')
+    cache_key = tf_cache_key(features, paths, labels)
+    assert cache_key != tf_cache_key(features, paths, labels + 1)
+
+    def read(transformations, **kwargs):
+        tfds = tf.data.Dataset.from_tensor_slices((features, paths, labels))
+        batches = list(tf_read_batches(tfds, 4, cache_dir=cache_dir, cache_key=cache_key,
+                                       transformations=transformations, **kwargs))
+        return (np.concatenate([images.numpy() for (_, images), _ in batches]),
+                np.concatenate([label.numpy()[:, 0] for _, label in batches]).astype(int))
+
+    expected, order = read(transformations[:2])
+    np.testing.assert_array_equal(order, np.arange(len(paths)))
+    # The shuffled cache is written in a random order, which a buffer of one image keeps
+    shuffled, order = read(transformations[:2], shuffle=True, shuffle_buffer=1, seed=0)
+    assert not np.array_equal(order, np.arange(len(paths)))
+    np.testing.assert_array_equal(shuffled, expected[order])
+    # Once written, the caches are read instead of the jpeg files
+    for path in paths:
+        os.remove(path)
+    np.testing.assert_array_equal(read(transformations[:2])[0], expected)
+    np.testing.assert_array_equal(read(transformations[:2], shuffle=True, shuffle_buffer=1, seed=0)[1], order)
+    # Random transformations run after the cache, on the cached images in a shuffled order
+    rotated, order = read(transformations[:2] + [('rotate', {})], shuffle=True, shuffle_buffer=10, seed=0)
+    assert rotated.shape == expected.shape
+    np.testing.assert_array_equal(np.sort(order), np.arange(len(paths)))
+    assert not np.array_equal(rotated, expected[order])
+
+
+def test_tf_read_batches_uint8(label_csv, monkeypatch):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations[:2])
+    features = dataset.df[dataset._feature_header].values.astype(np.float32)
+    labels = np.zeros((len(dataset.df), 2), dtype=np.float32)
+    tfds = tf.data.Dataset.from_tensor_slices((features, dataset.df['Path'].values, labels))
+    # The fixed zoom runs after the blur like a random one, interpolating the blurred images again
+    monkeypatch.setitem(imgproc.RANDOM_TRANSFORMATIONS, 'zoom', 'random')
+    tail = [transformations[0], ('gaussian_blur', {'sigma': 1}), ('zoom', {'percentage': 0.9})]
+    (_, images), _ = next(iter(tf_read_batches(tfds, 4, image_dtype='uint8', transformations=tail)))
+    (_, expected), _ = next(iter(tf_read_batches(tfds, 4, transformations=tail)))
+    # Without a cache the images are rounded once, after all the transformations
+    np.testing.assert_array_equal(images.numpy(), np.clip(np.round(expected.numpy()), 0, 255).astype(np.uint8))
+
+
+def test_tf_read_batches_repeat(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations[:2])
+    features = dataset.df[dataset._feature_header].values.astype(np.float32)
+    # The labels number the images, to follow their order through the passes
+    labels = np.arange(len(dataset.df), dtype=np.float32)[:, np.newaxis]
+    paths = dataset.df['Path'].values
+    tfds = tf.data.Dataset.from_tensor_slices((features, paths, labels))
+    batches = tf_read_batches(tfds, 4, shuffle=True, repeat=True, seed=0, transformations=transformations[:2])
+    # Batches do not cross passes, the 9 first batches are 3 passes over the 10 images
+    order = np.concatenate([label.numpy()[:, 0] for _, label in batches.take(9)]).reshape(3, -1)
+    for epoch in order:
+        np.testing.assert_array_equal(np.sort(epoch), labels[:, 0])
+    assert len({tuple(epoch) for epoch in order}) > 1
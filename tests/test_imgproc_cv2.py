@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from src.data import imgproc
+
+cv2 = pytest.importorskip('cv2')
+from src.data import imgproc_cv2
+
+
+def test_cv2_parity():
+    path = "./tests/view1_frontal.jpg"
+    skimage_proc = imgproc.get_proc_class('skimage')
+    cv2_proc = imgproc.get_proc_class('cv2')
+    image = skimage_proc.imread(path)
+    np.testing.assert_array_equal(cv2_proc.imread(path), image)
+
+    cropped = skimage_proc.crop(image, (320, 320))
+    normalized = skimage_proc.normalize(cropped)
+    # Largest mean absolute difference with the skimage backend on the [0, 1] scale
+    cases = [
+        ('resize', {'size': (224, 224)}, image, 0.01),
+        ('crop', {'size': (320, 320)}, image, 0),
+        ('normalize', {}, cropped, 0),
+        ('eqhist', {}, cropped, 0.005),
+        ('adaptive_eqhist', {}, cropped, 0.01),
+        ('gaussian_blur', {}, normalized, 1e-6),
+        ('median_blur', {}, cropped, 0),
+        ('median_blur', {}, normalized, 0),
+        ('median_blur', {}, normalized.astype(np.float64), 1e-7),
+        ('rotate', {'degree': 7}, normalized, 0.005),
+        ('zoom', {'percentage': 1.1}, normalized, 0.005),
+    ]
+    for trans, args, source, tolerance in cases:
+        expected = np.asarray(getattr(skimage_proc, trans)(source, **args), dtype=float)
+        result = np.asarray(getattr(cv2_proc, trans)(source, **args), dtype=float)
+        assert result.shape == expected.shape, trans
+        if source.dtype == np.uint8 and trans in ['crop', 'median_blur']:
+            expected, result = expected / 255, result / 255
+        assert np.abs(result - expected).mean() <= tolerance, trans
+
+
+def test_cv2_pipeline():
+    proc_class = imgproc.get_proc_class('cv2')
+    image = proc_class.imread("./tests/view1_frontal.jpg")
+    transformations = [
+        ('crop', {'size': (320, 320)}),
+        ('gaussian_blur', {'sigma': 2}),
+        ('median_blur', {}),
+        ('normalize', {}),
+        ('rotate', {'degree': 5}),
+        ('flatten', {})
+    ]
+    expected = proc_class.transform(image, transformations)
+    pipeline = proc_class.compile(transformations)
+    np.testing.assert_array_equal(pipeline(image), expected)
+    np.testing.assert_array_equal(pipeline.batch(np.stack([image, image])), np.stack([expected, expected]))
+
+
+def test_cv2_median_blur_float64(monkeypatch):
+    proc_class = imgproc.get_proc_class('cv2')
+    image = np.random.default_rng(0).random((32, 32))
+    # Filtered by OpenCV, not the skimage fallback
+    monkeypatch.setattr(imgproc_cv2, 'median', None)
+    result = proc_class.median_blur(image)
+    assert result.dtype == np.float64 and result.shape == image.shape
+    np.testing.assert_allclose(result[1:-1, 1:-1], np.median(
+        np.lib.stride_tricks.sliding_window_view(image, (3, 3)), axis=(2, 3)), rtol=1e-6)
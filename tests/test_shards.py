@@ -0,0 +1,53 @@
+import numpy as np
+from src.data.dataset import ImageDataset
+from src.data.imgproc import tf_read_image, tf_read_shard
+from src.data.make_dataset import crop_or_pad, pack_split
+
+transformations = [
+    ['crop', {'size': [320, 320]}],
+    ['normalize', {}],
+    ['flatten', {}]
+]
+
+
+def test_crop_or_pad():
+    image = np.arange(12, dtype=np.uint8).reshape(2, 6)
+    padded = crop_or_pad(image, (4, 4))
+    np.testing.assert_array_equal(padded[1:3], image[:, 1:5])
+    assert not padded[0].any() and not padded[3].any()
+
+
+def test_pack_split(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    shard_dir = str(tmp_path / 'processed' / 'train')
+    manifest = pack_split(csv_path, image_path, shard_dir, shard_size=4, n_jobs=2)
+    assert manifest['num_images'] == 10
+    assert len(manifest['shards']) == 3
+
+    jpeg = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    packed = ImageDataset(image_path_base=image_path, transformations=transformations, shard_dir=shard_dir)
+    x_features, x_image, y = packed.load()
+    expected = jpeg.load()
+    np.testing.assert_array_equal(x_image.values, expected[1].values)
+    np.testing.assert_array_equal(y.values, expected[2].values)
+
+    valid = packed.split(0.2)
+    assert valid.shards is not None
+    np.testing.assert_array_equal(valid[0][1], jpeg.read_image(valid._paths[0]))
+
+
+def test_tf_read_shard(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    shard_dir = str(tmp_path / 'processed' / 'train')
+    pack_split(csv_path, image_path, shard_dir, shard_size=4, n_jobs=1)
+    dataset = ImageDataset(image_path_base=image_path, transformations=transformations[:2], shard_dir=shard_dir)
+    features, label = np.zeros(4, dtype=np.float32), np.zeros(2, dtype=np.float32)
+    row = dataset.shards.rows(dataset._paths[:1])[0]
+    (_, image), _ = tf_read_shard(features, row, label, shards=dataset.shards,
+                                  transformations=transformations[:2])
+    (_, expected), _ = tf_read_image(features, dataset._paths[0], label,
+                                     transformations=transformations[:2])
+    assert image.shape == expected.shape == (320, 320, 1)
+    np.testing.assert_allclose(image.numpy()[..., 0], dataset.read_image(dataset._paths[0]))
+    # The shards are decoded by skimage, tf.io.decode_jpeg rounds a few levels differently
+    np.testing.assert_allclose(image.numpy(), expected.numpy(), atol=8 / 255)
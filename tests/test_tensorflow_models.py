@@ -0,0 +1,63 @@
+import numpy as np
+import tensorflow as tf
+from src.models.tensorflow_models import DenseNet121_new, backbone, classification_head, fold_rgb_weights, \
+    preprocess_image, split_head
+
+
+def test_preprocess_image():
+    images = np.random.default_rng(0).integers(0, 256, (2, 8, 8, 1), dtype=np.uint8)
+    inputs_image = tf.keras.Input(shape=(8, 8, 1), dtype='uint8')
+    model = tf.keras.Model(inputs=inputs_image, outputs=preprocess_image(inputs_image))
+    np.testing.assert_allclose(model(images).numpy(), images / 255.0, rtol=1e-6)
+
+    # float32 images pass through unchanged
+    inputs_image = tf.keras.Input(shape=(8, 8, 1))
+    assert preprocess_image(inputs_image) is inputs_image
+
+
+def test_fold_rgb_weights():
+    application = tf.keras.applications.mobilenet_v2.MobileNetV2
+    cnn_base = application(include_top=False, weights=None, input_shape=(64, 64, 3))
+    gray_base = application(include_top=False, weights=None, input_shape=(None, None, 1))
+    fold_rgb_weights(cnn_base, gray_base)
+    assert gray_base.layers[1].get_weights()[0].shape[2] == 1
+
+    images = np.random.default_rng(0).random((2, 64, 64, 1), dtype=np.float32)
+    np.testing.assert_allclose(gray_base.predict(images), cnn_base.predict(np.repeat(images, 3, axis=-1)),
+                               rtol=1e-4, atol=1e-5)
+
+
+def test_backbone():
+    cnn_base = tf.keras.Sequential([tf.keras.layers.Conv2D(4, 3), tf.keras.layers.GlobalAveragePooling2D()])
+    inputs_image = tf.keras.Input(shape=(8, 8, 1), dtype='uint8')
+    x = tf.keras.layers.Dense(1)(cnn_base(preprocess_image(inputs_image)))
+    model = tf.keras.Model(inputs=inputs_image, outputs=x)
+    assert backbone(model) is cnn_base
+
+    model = DenseNet121_new(2, feature_shape=(4,), image_shape=(64, 64, 1), image_dtype='uint8')
+    assert backbone(model) is model
+    assert model.predict([np.zeros((1, 4)), np.zeros((1, 64, 64, 1), dtype=np.uint8)]).shape == (1, 2)
+
+
+def test_split_head():
+    # Built like the keras application models, with a small cnn base
+    cnn_base = tf.keras.Sequential([tf.keras.layers.Conv2D(4, 3)])
+    cnn_base.trainable = False
+    inputs_feature = tf.keras.Input(shape=(4,))
+    inputs_image = tf.keras.Input(shape=(8, 8, 1), dtype='uint8')
+    x1 = tf.keras.layers.GlobalAveragePooling2D()(cnn_base(preprocess_image(inputs_image), training=False))
+    x = classification_head(2, (4,), 4)([inputs_feature, x1])
+    model = tf.keras.Model(inputs=[inputs_feature, inputs_image], outputs=x, name='small')
+    assert backbone(model) is cnn_base
+
+    embedding_model, head = split_head(model)
+    assert head is model.get_layer('head')
+    rng = np.random.default_rng(0)
+    features = rng.random((3, 4), dtype=np.float32)
+    images = rng.integers(0, 256, (3, 8, 8, 1), dtype=np.uint8)
+    np.testing.assert_allclose(head.predict([features, embedding_model.predict(images)]),
+                               model.predict([features, images]), rtol=1e-5)
+
+    cnn_base.trainable = True
+    assert split_head(model) is None
+    assert split_head(DenseNet121_new(2, feature_shape=(4,), image_shape=(64, 64, 1))) is None
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import tensorflow as tf
+from src.data.dataset import ImageDataset
+from src.data.imgproc import tf_read_image
+from src.data.tfpipeline import embed_images, embedding_pipeline, eval_pipeline, inference_pipeline, model_channels, \
+    tf_columns, train_pipeline
+
+transformations = [('crop', {'size': (320, 320)}), ('normalize', {})]
+
+
+def test_pipelines(label_csv):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    return_labels = list(dataset._label_header[:2])
+    features, paths, labels = tf_columns(dataset, return_labels)
+    assert labels.shape == (len(dataset.df), 2)
+
+    batches = list(eval_pipeline(dataset, 4, transformations, return_labels))
+    assert [len(label) for _, label in batches] == [4, 4, 2]
+    np.testing.assert_array_equal(np.concatenate([label for _, label in batches]), dataset.labels(return_labels))
+    (batch_features, images), _ = batches[0]
+    np.testing.assert_array_equal(batch_features.numpy(), features[:4])
+    (_, expected), _ = tf_read_image(features[0], paths[0], labels[0], transformations=transformations)
+    np.testing.assert_allclose(images[0].numpy(), expected.numpy())
+
+    inputs = list(inference_pipeline(dataset, 4, transformations, channels=3))
+    assert len(inputs) == 3
+    _, images = inputs[0]
+    assert images.shape == (4, 320, 320, 3)
+
+    train = train_pipeline(dataset, 4, transformations, return_labels, deterministic=False)
+    assert len([label for _, label in train.take(5)]) == 5
+    assert train.options().experimental_deterministic is False
+
+    inputs_feature = tf.keras.layers.Input(shape=(features.shape[1],))
+    inputs_image = tf.keras.layers.Input(shape=(320, 320, 3))
+    model = tf.keras.Model([inputs_feature, inputs_image], tf.keras.layers.GlobalAveragePooling2D()(inputs_image))
+    assert model_channels(model) == 3
+
+
+def test_embedding_pipeline(label_csv, tmp_path):
+    csv_path, image_path = label_csv
+    dataset = ImageDataset(label_csv_path=csv_path, image_path_base=image_path, transformations=transformations)
+    return_labels = list(dataset._label_header[:2])
+    inputs_image = tf.keras.layers.Input(shape=(320, 320, 1))
+    embedding_model = tf.keras.Model(inputs_image, tf.keras.layers.GlobalAveragePooling2D()(inputs_image))
+    embedding_dir = str(tmp_path / 'embeddings')
+
+    embeddings = embed_images(embedding_model, dataset, 4, transformations, embedding_dir)
+    assert embeddings.shape == (len(dataset), 1)
+    images = np.concatenate([images.numpy() for (_, images), _ in eval_pipeline(dataset, 4, transformations, [])])
+    np.testing.assert_allclose(embeddings[:, 0], images.mean(axis=(1, 2, 3)), rtol=1e-5)
+    # Embedded once, then read back from the file
+    np.testing.assert_array_equal(embed_images(embedding_model, dataset, 4, transformations, embedding_dir),
+                                  embeddings)
+    assert len(os.listdir(embedding_dir)) == 1
+    # The same weights under another name are not embedded again
+    inputs_image = tf.keras.layers.Input(shape=(320, 320, 1))
+    renamed_model = tf.keras.Model(inputs_image, tf.keras.layers.GlobalAveragePooling2D()(inputs_image),
+                                   name='renamed')
+    assert renamed_model.name != embedding_model.name
+    embed_images(renamed_model, dataset, 4, transformations, embedding_dir)
+    assert len(os.listdir(embedding_dir)) == 1
+
+    batches = list(embedding_pipeline(dataset, embeddings, 4, return_labels))
+    assert [len(label) for _, label in batches] == [4, 4, 2]
+    np.testing.assert_array_equal(np.concatenate([label for _, label in batches]), dataset.labels(return_labels))
+    np.testing.assert_array_equal(np.concatenate([x[1] for x, _ in batches]), embeddings)
+    np.testing.assert_array_equal(np.concatenate([x[0] for x, _ in batches]), dataset.features())
+
+    train = embedding_pipeline(dataset, embeddings, 4, return_labels, train=True)
+    (features, x_embeddings), _ = next(iter(train))
+    assert x_embeddings.shape == (4, 1)
+    assert len(list(train.take(7))) == 7